@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import logging
 import pickle
 
@@ -9,13 +10,23 @@ from pathlib import Path
 import googleapiclient.errors
 
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
 
+import dcassette
+import dasync
+import daudit
+import dbackend
+import dchanges
 import dchown
+import djobs
 import dlist
 import dlog
 import dmove
+import dprefetch
+import dprofile
 import dutils
 
 OAUTH2_SCOPE = ['https://www.googleapis.com/auth/drive']
@@ -81,8 +92,19 @@ def get_creds(client_secrets, scopes):
     creds = flow.credentials
     return creds
 
-def get_drive_service(credentials):
-    drive_service = build('drive', 'v3', credentials=credentials)
+def get_drive_service(credentials, http=None, async_client=False, threadsafe=False):
+    if async_client:
+        drive_service = dasync.build_service(credentials)
+    elif threadsafe:
+        # Each thread gets its own HTTP object, wrapped by any recorder or replayer.
+        wrap_http = http.wrap if http is not None else None
+        drive_service = djobs.build_service(credentials, wrap_http=wrap_http)
+    elif http is None:
+        drive_service = build('drive', 'v3', credentials=credentials)
+    else:
+        if credentials:
+            http = AuthorizedHttp(credentials, http=http)
+        drive_service = build('drive', 'v3', http=http)
     try:
         about = drive_service.about().get(fields='*').execute()
     except Exception as e:
@@ -116,6 +138,11 @@ def main():
         dest="DEST",
         help="move the folder to given Shared drive",
     )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="after moving, check that all items arrived in the destination; use with -d",
+    )
     parser.add_argument(
         "-i", "--infile",
         action="store_true",
@@ -127,17 +154,94 @@ def main():
         action="store_true",
         help="list the folder's files recursively",
     )
+    group.add_argument(
+        "--jobs",
+        metavar="FILE",
+        help="run the actions listed in a YAML, JSON or CSV file of action, folder, arg",
+    )
     group.add_argument(
         "-L", "--list-details",
         action="store_true",
         help="list the folder's file names and other details"
     )
+    parser.add_argument(
+        "--since",
+        metavar="LAST_LOG_OR_TOKEN",
+        help="list only what was added, removed, renamed or moved since an earlier \
+            listing, given its log file or changes token; implies -l",
+    )
     group.add_argument(
         "-o", "--chown",
         dest="g_account",
         metavar="user_name@sil.org",
         help="change the folder's owner to given account",
     )
+    parser.add_argument(
+        "--async-client",
+        action="store_true",
+        help=argparse.SUPPRESS
+    )
+    group.add_argument(
+        "-u", "--usage",
+        action="store_true",
+        help="show the folder's total size and item counts, and its largest subfolders",
+    )
+    group.add_argument(
+        "--duplicates",
+        action="store_true",
+        help="list files with the same content (size and checksum) in the folder",
+    )
+    group.add_argument(
+        "--audit",
+        dest="audit_file",
+        metavar="FILE",
+        help="save who has access to the folder's items to FILE (.csv or .jsonl)",
+    )
+    parser.add_argument(
+        "--shared-with",
+        metavar="PRINCIPAL",
+        help="list items shared with a user, group or domain; use with --audit \
+            (without a folder, an existing audit FILE is searched)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        metavar="N",
+        help="number of largest subfolders to show with --usage (default: 20)",
+    )
+    parser.add_argument(
+        "-p", "--processes",
+        type=int,
+        default=1,
+        metavar="N",
+        help="split listing or ownership changes across N worker processes",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--record",
+        metavar="CASSETTE",
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="CASSETTE",
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--replay-latency",
+        action="store_true",
+        help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="FILE",
+        help=argparse.SUPPRESS
+    )
     parser.add_argument(
         "-t", "--test",
         action="store_true",
@@ -149,40 +253,110 @@ def main():
         help=argparse.SUPPRESS
     )
     args = parser.parse_args()
+    if args.shared_with and not args.audit_file:
+        parser.error("--shared-with needs --audit FILE")
+    if args.async_client and (args.record or args.replay):
+        # The async client doesn't use httplib2, so it can't be recorded or replayed.
+        parser.error("--async-client can't be used with --record or --replay")
+    if args.record and args.processes > 1:
+        # Worker processes have their own services, which aren't recorded.
+        parser.error("--processes can't be used with --record")
 
     # Setup logging.
     loglevel = 'DEBUG' if args.verbose else 'INFO'
-    dlog.setup_logging(loglevel)
+    log_path = dlog.setup_logging(loglevel)
 
     # Retrieve appropriate credentials and drive_service.
-    if args.test:
+    http = None
+    if args.snapshot:
+        # Run against an in-memory Drive loaded from a JSON snapshot.
+        drive_service = dbackend.MemoryBackend.from_snapshot(args.snapshot)
+        auth_user = drive_service.user
+    elif args.replay:
+        # Serve recorded responses; no credentials are needed.
+        credentials = None
+        http = dcassette.ReplayHttp(args.replay, latency=args.replay_latency)
+    elif args.test:
         # Use saved credentials in devmode.
         credentials = get_dev_creds(CLIENT_SECRETS, OAUTH2_SCOPE)
     else:
         # Always get new credentials in production mode.
         credentials = get_creds(CLIENT_SECRETS, OAUTH2_SCOPE)
-    drive_service, auth_user = get_drive_service(credentials)
+    if args.record and not args.replay and not args.snapshot:
+        # Save every request/response pair to the cassette at exit.
+        http = dcassette.RecordingHttp(build_http(), args.record)
+        atexit.register(http.save)
+    if not args.snapshot:
+        drive_service, auth_user = get_drive_service(
+            credentials,
+            http=http,
+            async_client=args.async_client,
+            threadsafe=bool(args.jobs),
+        )
+
+    profiler = None
+    if args.profile:
+        # Save profile and request timeline next to the log file at exit.
+        profiler = dprofile.Profiler(log_path)
+        profiler.start(drive_service)
+        atexit.register(profiler.stop)
+        if args.processes > 1:
+            logging.warning("Profile: requests made by --processes workers aren't timed.")
+
+    if args.jobs:
+        # Run all jobs from file; no interactive prompts.
+        results = djobs.run_jobs(auth_user, drive_service, args.jobs, log_path)
+        if any(r['status'] != 'done' for r in results):
+            # Unattended runs need to see that some jobs failed.
+            return 1
+        return
+
+    if args.audit_file and args.shared_with and not args.folder:
+        # Search existing audit file; no Drive requests.
+        daudit.run_shared_with_query(args.audit_file, args.shared_with)
+        return
 
     # Parse remaining arguments and options.
     list_files = args.list
     list_details = args.list_details
+    usage = args.usage
+    duplicates = args.duplicates
+    audit_file = args.audit_file
     folder_string = args.folder
     filelist = args.infile
     new_owner = args.g_account
     destination = args.DEST
+    processes = args.processes
+    state_file = dchanges.get_state_path(log_path)
+    since_state = None
+    if args.since:
+        # Load the earlier listing now so that a bad argument fails early.
+        since_state = dchanges.find_state(args.since, log_path.parent)
+        list_files = not list_details
     folder = None
     default_args = [auth_user, drive_service, folder]
     actions = {
-        1: {'cmd': dlist.run_list_files, 'args': [*default_args]},
-        2: {'cmd': dlist.run_list_files, 'args': [*default_args, True]},
-        3: {'cmd': dchown.run_change_owner, 'args': [*default_args, new_owner]},
-        4: {'cmd': dmove.run_move_folder, 'args': [*default_args, destination]},
+        1: {'cmd': dlist.run_list_files, 'args': [*default_args, False, processes, state_file]},
+        2: {'cmd': dlist.run_list_files, 'args': [*default_args, True, processes, state_file]},
+        3: {'cmd': dchown.run_change_owner, 'args': [*default_args, new_owner, True, processes]},
+        4: {'cmd': dmove.run_move_folder, 'args': [*default_args, destination, args.verify]},
         5: {'cmd': dmove.run_move_filelist, 'args': [*default_args, destination]},
+        6: {'cmd': dlist.run_folder_usage, 'args': [*default_args, args.top]},
+        7: {'cmd': dlist.run_find_duplicates, 'args': [*default_args]},
+        8: {'cmd': daudit.run_sharing_audit, 'args': [*default_args, audit_file, args.shared_with]},
         0: {'cmd': exit, 'args': []},
     }
     choice = -1
-    if not any([list_files, list_details, new_owner, destination, filelist]):
+    prefetcher = None
+    if not any([list_files, list_details, usage, duplicates, audit_file, new_owner, destination, filelist]):
         # Enter interactive mode.
+        if http is None:
+            # Start Drive lookups in the background while the operator answers
+            # prompts; not with --record or --replay, as the cassette would
+            # depend on which lookups finished first.
+            prefetcher = dprefetch.start_prefetch(drive_service)
+        if profiler and prefetcher:
+            profiler.track_requests(prefetcher.service)
         print(f"What do you want to do for {auth_user}?")
         options = [
             "   1. List folder contents recursively.",
@@ -190,6 +364,9 @@ def main():
             "   3. Change folder ownership recursively.",
             "   4. Move folder recursively to a Shared Drive.",
             "   5. Move files to a Shared Drive from given input file list. (not implemented)",
+            "   6. Show folder size and item counts recursively.",
+            "   7. Find duplicate files recursively.",
+            "   8. Audit folder sharing recursively.",
             "   0. Quit.",
         ]
         print('\n'.join(options))
@@ -204,24 +381,22 @@ def main():
         elif choice == 2:
             list_details == True
 
-        elif choice == 3:
-            while not new_owner:
-                new_owner = input("Enter account name for new owner (user_name@sil.org): ")
-                # TODO: Test that new_owner is valid?
-            actions[choice]['args'][3] = new_owner
+        elif choice == 6:
+            usage = True
+
+        elif choice == 7:
+            duplicates = True
+
+        elif choice == 8:
+            while not audit_file:
+                audit_file = input("Enter file name to save sharing audit to (.csv or .jsonl): ").strip()
+            actions[choice]['args'][3] = audit_file
 
         # Temporary catch for unimplemented choice #5.
         elif choice == 5:
             dutils.eprint("Sorry, this choice is not yet implemented.")
             exit(1)
 
-        elif choice in [4, 5]:
-            while not destination:
-                content = 'files' if choice == 5 else 'folder'
-                destination = input(f"Enter Shared Drive location to move {content} to: ")
-                # TODO: Test that destination is valid?
-            actions[choice]['args'][3] = destination
-
     # Define choice based on command options and arguments.
     elif list_files:
         choice = 1
@@ -231,6 +406,12 @@ def main():
         choice = 3
     elif destination:
         choice = 4
+    elif usage:
+        choice = 6
+    elif duplicates:
+        choice = 7
+    elif audit_file:
+        choice = 8
     if filelist: # overrides choice 4
         choice = 5
 
@@ -238,7 +419,15 @@ def main():
         # User chose 0, or choice never got defined.
         exit(0)
 
+    if since_state and choice in [1, 2]:
+        # Only fetch changes since the earlier listing.
+        actions[choice] = {'cmd': dchanges.run_list_changes, 'args': [*default_args, since_state, state_file]}
+        if not folder_string:
+            # Default to the folder of the earlier listing.
+            folder = dutils.get_drive_item(drive_service, since_state['folder']['id'])
+
     # Ensure valid folder to handle.
+    input_file = None
     if not filelist:
         while not folder:
             if not folder_string:
@@ -246,7 +435,7 @@ def main():
             # Check just the last element if full path is given.
             folder_string = folder_string.split('>')[-1].strip()
             # Search for folder.
-            if list_files or list_details:
+            if list_files or list_details or usage or duplicates or audit_file:
                 # Search user drive and shared drives.
                 folder = dutils.find_drive_item(drive_service, name_string=folder_string, all_drives=True)
             else:
@@ -264,6 +453,20 @@ def main():
         input_file = folder_string
         actions[choice]['args'][2] = input_file
 
+    # Get additional input, if needed.
+    if choice == 3:
+        while not new_owner:
+            new_owner = input("Enter account name for new owner (user_name@sil.org): ")
+            # TODO: Test that new_owner is valid?
+        actions[choice]['args'][3] = new_owner
+
+    elif choice in [4, 5]:
+        while not destination:
+            content = 'files' if choice == 5 else 'folder'
+            destination = input(f"Enter Shared Drive location to move {content} to: ")
+            # TODO: Test that destination is valid?
+        actions[choice]['args'][3] = destination
+
     # Run script.
     item_id = None
     item_name = input_file
@@ -271,13 +474,16 @@ def main():
         item_id = actions[choice]['args'][2].get('id')
         item_name = actions[choice]['args'][2].get('name')
     logging.info(f"{actions[choice]['cmd'].__name__}, account: {auth_user}, item: \"{item_name}\" ({item_id})")
-    actions[choice]['cmd'](*actions[choice]['args'])
+    result = actions[choice]['cmd'](*actions[choice]['args'])
+    if type(result) is int:
+        # Exit status, e.g. 1 if a move failed verification.
+        return result
 
 
 
 if __name__ == '__main__':
     try:
-        main()
+        exit(main())
     except KeyboardInterrupt:
         # dutils.eprint("\nInterrupted with Ctrl+C")
         logging.warning("Interrupted with Ctrl+C")
@@ -0,0 +1,353 @@
+import asyncio
+import json
+import logging
+import ssl
+import threading
+
+from urllib.parse import quote
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+
+BASE_URL = 'https://www.googleapis.com'
+# Keep-alive connections kept open (and requests in flight) per client. Batch
+# requests run all their calls concurrently, and DriveService lets
+# execute_batch put this many calls in a batch, so walkers that list a
+# frontier of folders at once (see dwalk) can fill the pool.
+MAX_CONNECTIONS = 200
+MAX_RETRIES = 5
+# Seconds allowed to connect, and to send a request and read its response.
+CONNECT_TIMEOUT = 30
+REQUEST_TIMEOUT = 120
+
+
+class DriveHttpError(Exception):
+    def __init__(self, status, content):
+        self.status = status
+        self.content = content
+        super().__init__(f"HTTP {status}: {content[:200].decode('utf-8', 'replace')}")
+
+
+def format_param(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+async def read_response(reader, method):
+    """Read an HTTP/1.1 response; returns (status, headers, content, keep_alive)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by server.")
+    version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+    status = int(status)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode('latin-1').split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+
+    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+    if method == 'HEAD' or status in (204, 304) or status < 200:
+        content = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Skip trailers.
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        content = b''.join(chunks)
+    elif 'content-length' in headers:
+        content = await reader.readexactly(int(headers['content-length']))
+    else:
+        content = await reader.read()
+        keep_alive = False
+    return status, headers, content, keep_alive
+
+
+class ConnectionPool(object):
+    """Pool of HTTP/1.1 keep-alive connections to a single host."""
+    def __init__(self, base_url, size=MAX_CONNECTIONS):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.use_ssl = parts.scheme == 'https'
+        self.port = parts.port if parts.port else (443 if self.use_ssl else 80)
+        self.size = size
+        self.idle = []
+        self.semaphore = None
+        self.ssl_context = ssl.create_default_context() if self.use_ssl else None
+
+    async def open_connection(self):
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=self.ssl_context,
+                server_hostname=self.host if self.use_ssl else None,
+            ),
+            CONNECT_TIMEOUT,
+        )
+
+    async def request(self, method, target, headers, body=b''):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.size)
+        async with self.semaphore:
+            reused = bool(self.idle)
+            connection = self.idle.pop() if reused else await self.open_connection()
+            try:
+                result = await self.send(connection, method, target, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection[1].close()
+                if not reused:
+                    raise
+                # The server closed an idle connection; retry on a new one.
+                connection = await self.open_connection()
+                try:
+                    result = await self.send(connection, method, target, headers, body)
+                except Exception:
+                    connection[1].close()
+                    raise
+            except Exception:
+                connection[1].close()
+                raise
+            status, response_headers, content, keep_alive = result
+            if keep_alive:
+                self.idle.append(connection)
+            else:
+                connection[1].close()
+            return status, response_headers, content
+
+    async def send(self, connection, method, target, headers, body):
+        reader, writer = connection
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(body)}"]
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await asyncio.wait_for(writer.drain(), REQUEST_TIMEOUT)
+        return await asyncio.wait_for(read_response(reader, method), REQUEST_TIMEOUT)
+
+    async def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+
+class AsyncDriveClient(object):
+    """
+    Minimal asyncio Drive v3 client covering the calls used by DriveSensibly;
+    up to "max_connections" requests can be in flight at once over pooled
+    connections when its coroutines are run concurrently.
+    """
+    def __init__(self, credentials=None, base_url=BASE_URL, max_connections=MAX_CONNECTIONS):
+        self.credentials = credentials
+        self.pool = ConnectionPool(base_url, size=max_connections)
+        self.token_lock = None
+
+    async def get_token(self):
+        if not self.credentials:
+            return None
+        if self.token_lock is None:
+            self.token_lock = asyncio.Lock()
+        async with self.token_lock:
+            if not self.credentials.valid:
+                from google.auth.transport.requests import Request
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.credentials.refresh, Request())
+        return self.credentials.token
+
+    async def call(self, method, path, params=None, body=None):
+        params = {k: format_param(v) for k, v in (params or {}).items() if v is not None}
+        target = f"{path}?{urlencode(params)}" if params else path
+        headers = {'Accept': 'application/json'}
+        data = b''
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in range(MAX_RETRIES + 1):
+            token = await self.get_token()
+            if token:
+                headers['Authorization'] = f"Bearer {token}"
+            try:
+                status, response_headers, content = await self.pool.request(method, target, headers, data)
+            except asyncio.TimeoutError:
+                # Only reads are safe to send again.
+                if method != 'GET' or attempt == MAX_RETRIES:
+                    raise
+                logging.debug(f"Timed out: {method} {path}; retrying.")
+                continue
+            if (status == 429 or status >= 500) and attempt < MAX_RETRIES:
+                # Back off exponentially on throttling and server errors.
+                logging.debug(f"HTTP {status} for {method} {path}; retrying.")
+                await asyncio.sleep(2 ** attempt)
+                continue
+            break
+        if status >= 400:
+            raise DriveHttpError(status, content)
+        return json.loads(content) if content else {}
+
+    async def files_list(self, **params):
+        return await self.call('GET', '/drive/v3/files', params)
+
+    async def files_get(self, fileId, **params):
+        return await self.call('GET', f"/drive/v3/files/{quote(fileId)}", params)
+
+    async def files_create(self, body=None, **params):
+        return await self.call('POST', '/drive/v3/files', params, body=body or {})
+
+    async def files_update(self, fileId, body=None, **params):
+        return await self.call('PATCH', f"/drive/v3/files/{quote(fileId)}", params, body=body or {})
+
+    async def files_generate_ids(self, **params):
+        return await self.call('GET', '/drive/v3/files/generateIds', params)
+
+    async def files_delete(self, fileId, **params):
+        return await self.call('DELETE', f"/drive/v3/files/{quote(fileId)}", params)
+
+    async def permissions_update(self, fileId, permissionId, body=None, **params):
+        path = f"/drive/v3/files/{quote(fileId)}/permissions/{quote(permissionId)}"
+        return await self.call('PATCH', path, params, body=body or {})
+
+    async def permissions_list(self, fileId, **params):
+        return await self.call('GET', f"/drive/v3/files/{quote(fileId)}/permissions", params)
+
+    async def changes_get_start_page_token(self, **params):
+        return await self.call('GET', '/drive/v3/changes/startPageToken', params)
+
+    async def changes_list(self, **params):
+        return await self.call('GET', '/drive/v3/changes', params)
+
+    async def drives_list(self, **params):
+        return await self.call('GET', '/drive/v3/drives', params)
+
+    async def about_get(self, **params):
+        return await self.call('GET', '/drive/v3/about', params)
+
+    async def list_all_files(self, **params):
+        """Get all pages of a files.list query."""
+        files = []
+        while True:
+            response = await self.files_list(**params)
+            files.extend(response.get('files', []))
+            params['pageToken'] = response.get('nextPageToken')
+            if not params['pageToken']:
+                break
+        return files
+
+    async def close(self):
+        await self.pool.close()
+
+
+class DriveService(object):
+    """
+    googleapiclient-style facade for AsyncDriveClient, so that it can be used
+    as "service" by dutils, dlist, dchown and dmove; requests run on an event
+    loop in a background thread. Request.execute blocks until its response
+    arrives, so only the calls in a batch request run concurrently; walkers
+    list many folders at once in batches (see dwalk.walk_tree).
+    """
+    def __init__(self, client):
+        self.client = client
+        # Calls per batch request in execute_batch; they all run concurrently.
+        self.batch_size = client.pool.size
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def files(self):
+        return Resource(self, {
+            'list': self.client.files_list,
+            'get': self.client.files_get,
+            'create': self.client.files_create,
+            'update': self.client.files_update,
+            'delete': self.client.files_delete,
+            'generateIds': self.client.files_generate_ids,
+        })
+
+    def permissions(self):
+        return Resource(self, {
+            'list': self.client.permissions_list,
+            'update': self.client.permissions_update,
+        })
+
+    def changes(self):
+        return Resource(self, {
+            'getStartPageToken': self.client.changes_get_start_page_token,
+            'list': self.client.changes_list,
+        })
+
+    def drives(self):
+        return Resource(self, {'list': self.client.drives_list})
+
+    def about(self):
+        return Resource(self, {'get': self.client.about_get})
+
+    def new_batch_http_request(self, callback=None):
+        return BatchRequest(self, callback)
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class Resource(object):
+    def __init__(self, service, methods):
+        self.service = service
+        self.methods = methods
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+        method = self.methods[name]
+        return lambda **kwargs: Request(self.service, method, kwargs)
+
+
+class Request(object):
+    def __init__(self, service, method, kwargs):
+        self.service = service
+        self.method = method
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.service.run(self.method(**self.kwargs))
+
+
+class BatchRequest(object):
+    def __init__(self, service, callback=None):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        if request_id is None:
+            request_id = str(len(self.requests) + 1)
+        self.requests.append((request, callback or self.callback, request_id))
+
+    def execute(self):
+        async def run_all():
+            return await asyncio.gather(
+                *[r.method(**r.kwargs) for r, c, i in self.requests],
+                return_exceptions=True,
+            )
+
+        results = self.service.run(run_all())
+        for (request, callback, request_id), result in zip(self.requests, results):
+            if not callback:
+                continue
+            if isinstance(result, Exception):
+                callback(request_id, None, result)
+            else:
+                callback(request_id, result, None)
+
+
+def build_service(credentials, base_url=BASE_URL, max_connections=MAX_CONNECTIONS):
+    client = AsyncDriveClient(credentials, base_url=base_url, max_connections=max_connections)
+    return DriveService(client)
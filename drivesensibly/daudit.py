@@ -0,0 +1,150 @@
+import csv
+import json
+import logging
+
+from pathlib import Path
+
+import dlist
+import dprogress
+import dutils
+import dwalk
+
+FIELDS = ['principal', 'type', 'role', 'id', 'path']
+
+
+def get_principal(permission):
+    """Get the user, group, domain or "anyone" that a permission is for."""
+    p_type = permission.get('type')
+    if p_type in ['user', 'group']:
+        principal = permission.get('emailAddress', permission.get('id'))
+    elif p_type == 'domain':
+        principal = permission.get('domain')
+    else:
+        principal = p_type
+    # Email addresses and domains aren't case-sensitive.
+    return principal.lower() if principal else None
+
+def get_sharing_index(service, folder, progress=None):
+    """
+    Get an inverted index of principal: role: list of (id, path) of the items
+    under "folder", from the permissions and owners returned by the listing.
+    The listing has no permissions for shared-drive items, so those are
+    fetched afterwards with batch requests.
+    """
+    index = {}
+    types = {}
+    folder_paths = {}
+    # (id, path) of items whose permissions weren't listed.
+    unlisted = []
+
+    def add_entry(principal, p_type, role, entry):
+        types[principal] = p_type
+        index.setdefault(principal, {}).setdefault(role, []).append(entry)
+
+    def add_permissions(permissions, entry):
+        seen = set()
+        for permission in permissions:
+            principal = get_principal(permission)
+            role = permission.get('role')
+            if principal and (principal, role) not in seen:
+                seen.add((principal, role))
+                add_entry(principal, permission.get('type'), role, entry)
+        return seen
+
+    def add_item(item, parents):
+        parent_path = folder_paths.get(parents[-1].get('id')) if parents else None
+        name = item.get('name')
+        path = f"{parent_path} > {name}" if parent_path else name
+        if dutils.item_is_folder(item):
+            folder_paths[item.get('id')] = path
+        entry = (item.get('id'), path)
+        if 'permissions' not in item and item.get('driveId'):
+            unlisted.append(entry)
+        seen = add_permissions(item.get('permissions', []), entry)
+        for owner in item.get('owners', []):
+            # Owners aren't always among the listed permissions.
+            principal = (owner.get('emailAddress') or '').lower()
+            if principal and (principal, 'owner') not in seen:
+                seen.add((principal, 'owner'))
+                add_entry(principal, 'user', 'owner', entry)
+
+    def finish_folder(item, parents):
+        folder_paths.pop(item.get('id'), None)
+
+    dwalk.walk_tree(
+        folder,
+        lambda item: dlist.get_folder_children(service, item),
+        pre_visit=add_item,
+        post_visit=finish_folder,
+        progress=progress,
+        get_children_many=lambda items: dutils.get_children_many(service, items),
+    )
+
+    if unlisted:
+        logging.info(f"Getting permissions of {len(unlisted)} shared drive items...")
+        permissions = dutils.get_permissions_batch(service, [i for i, p in unlisted])
+        for entry in unlisted:
+            if entry[0] in permissions:
+                add_permissions(permissions[entry[0]], entry)
+            else:
+                logging.warning(f"Permissions of \"{entry[1]}\" not included in the index.")
+    return index, types
+
+def get_index_rows(index, types):
+    for principal in sorted(index):
+        for role in sorted(index[principal]):
+            for item_id, path in index[principal][role]:
+                yield {
+                    'principal': principal,
+                    'type': types.get(principal),
+                    'role': role,
+                    'id': item_id,
+                    'path': path,
+                }
+
+def write_index(index, types, index_file):
+    """Save the index as CSV or, for ".jsonl" files, as JSON lines."""
+    with open(index_file, 'w', newline='') as f:
+        if Path(index_file).suffix.lower() == '.jsonl':
+            for row in get_index_rows(index, types):
+                f.write(f"{json.dumps(row)}\n")
+        else:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(get_index_rows(index, types))
+
+def read_index_rows(index_file):
+    with open(index_file, newline='') as f:
+        if Path(index_file).suffix.lower() == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+def run_shared_with_query(index_file, principal):
+    """List the items shared with "principal" in a saved index; no Drive requests."""
+    principal = principal.lower()
+    matches = [r for r in read_index_rows(index_file) if (r['principal'] or '').lower() == principal]
+    for row in matches:
+        logging.info(f"{row['role']}\t{row['path']}")
+    i = '' if len(matches) == 1 else 's'
+    dutils.eprint(f"\nTotal: {len(matches)} item{i} shared with {principal}.")
+    return matches
+
+def run_sharing_audit(user, service, folder, index_file, shared_with=None):
+    progress = dprogress.Progress()
+    dprogress.track_requests(service, progress)
+    index, types = get_sharing_index(service, folder, progress=progress)
+    progress.finish()
+    write_index(index, types, index_file)
+
+    # Print summary per principal.
+    for principal in sorted(index, key=lambda p: -sum(len(e) for e in index[p].values())):
+        roles = ', '.join(f"{len(e)} {r}" for r, e in sorted(index[principal].items()))
+        logging.info(f"{principal} ({types.get(principal)}): {roles}")
+    p = '' if len(index) == 1 else 's'
+    dutils.eprint(f"\nTotal: {len(index)} principal{p}; index saved to \"{index_file}\".")
+    if shared_with:
+        run_shared_with_query(index_file, shared_with)
+    return index
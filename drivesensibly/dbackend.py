@@ -0,0 +1,532 @@
+import copy
+import json
+import logging
+import re
+import uuid
+
+# Maximum number of calls allowed in a single batch request.
+BATCH_SIZE = 100
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+
+class DriveBackend(object):
+    """
+    Drive operations used by DriveSensibly. Errors are raised as exceptions;
+    callers decide whether to log them or exit.
+    """
+    def get_item(self, item_id, fields=None):
+        raise NotImplementedError
+
+    def get_items(self, item_ids, fields=None):
+        """Get several items; returns dict of id: item or exception."""
+        items = {}
+        for item_id in item_ids:
+            try:
+                items[item_id] = self.get_item(item_id, fields=fields)
+            except Exception as e:
+                items[item_id] = e
+        return items
+
+    def search(self, query, corpora='user', drive_id=None, fields=None, page_token=None):
+        """Get all results of a files.list query."""
+        raise NotImplementedError
+
+    def list_children(self, folder_id, drive_id=None, fields=None):
+        """Get the items in a folder, leaving out trashed ones."""
+        corpora = 'drive' if drive_id else 'user'
+        return self.search(get_children_query(folder_id), corpora=corpora, drive_id=drive_id, fields=fields)
+
+    def list_children_many(self, folders, fields=None):
+        """
+        List the children of several (folder_id, drive_id) folders; returns
+        dict of folder_id: list of children or exception.
+        """
+        results = {}
+        for folder_id, drive_id in folders:
+            try:
+                results[folder_id] = self.list_children(folder_id, drive_id=drive_id, fields=fields)
+            except Exception as e:
+                results[folder_id] = e
+        return results
+
+    def list_shared_drives(self, page_token=None):
+        raise NotImplementedError
+
+    def move_item(self, item_id, add_parents, remove_parents):
+        raise NotImplementedError
+
+    def create_item(self, metadata):
+        raise NotImplementedError
+
+    def create_folders(self, folders):
+        """
+        Create folders from (new_id, name, parent_id); returns dict of
+        new_id: None if created, else the exception.
+        """
+        results = {}
+        for new_id, name, parent_id in folders:
+            metadata = {'id': new_id, 'name': name, 'parents': [parent_id], 'mimeType': FOLDER_MIMETYPE}
+            try:
+                self.create_item(metadata)
+                results[new_id] = None
+            except Exception as e:
+                results[new_id] = e
+        return results
+
+    def delete_item(self, item_id):
+        raise NotImplementedError
+
+    def trash_item(self, item_id):
+        raise NotImplementedError
+
+    def trash_items(self, item_ids):
+        """Trash items; returns dict of id: None if trashed, else the exception."""
+        results = {}
+        for item_id in item_ids:
+            try:
+                self.trash_item(item_id)
+                results[item_id] = None
+            except Exception as e:
+                results[item_id] = e
+        return results
+
+    def generate_ids(self, count):
+        raise NotImplementedError
+
+    def transfer_ownership(self, item_id, permission_id):
+        raise NotImplementedError
+
+    def list_permissions(self, item_id, fields=None):
+        """Get all permissions of an item, e.g. a shared-drive item."""
+        raise NotImplementedError
+
+    def get_permissions(self, item_ids, fields=None):
+        """Get the permissions of several items; returns dict of id: list or exception."""
+        results = {}
+        for item_id in item_ids:
+            try:
+                results[item_id] = self.list_permissions(item_id, fields=fields)
+            except Exception as e:
+                results[item_id] = e
+        return results
+
+    def get_start_page_token(self, drive_id=None):
+        """Get the Changes API token for changes made from now on."""
+        raise NotImplementedError
+
+    def list_changes(self, page_token, drive_id=None, fields=None):
+        """Get all changes since "page_token"; returns (changes, new_start_page_token)."""
+        raise NotImplementedError
+
+
+def execute_batch(service, requests):
+    """
+    Execute (request_id, request) pairs in batch requests of up to BATCH_SIZE
+    calls, or the service's own "batch_size"; returns dict of request_id:
+    (response, exception).
+    """
+    results = {}
+    batch_size = getattr(service, 'batch_size', BATCH_SIZE)
+
+    def add_result(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for i in range(0, len(requests), batch_size):
+        batch = service.new_batch_http_request(callback=add_result)
+        for request_id, request in requests[i:i+batch_size]:
+            batch.add(request, request_id=request_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            logging.error(e)
+            for request_id, request in requests[i:i+batch_size]:
+                results.setdefault(request_id, (None, e))
+    return results
+
+
+class ServiceBackend(DriveBackend):
+    """Backend using a googleapiclient (or dasync) Drive v3 service."""
+    def __init__(self, service):
+        self.service = service
+
+    def get_item(self, item_id, fields=None):
+        return self.service.files().get(
+            fileId=item_id,
+            supportsAllDrives=True,
+            fields=fields,
+        ).execute()
+
+    def get_items(self, item_ids, fields=None):
+        requests = []
+        for item_id in item_ids:
+            request = self.service.files().get(fileId=item_id, supportsAllDrives=True, fields=fields)
+            requests.append((item_id, request))
+        results = execute_batch(self.service, requests)
+        return {i: (e if e else r) for i, (r, e) in results.items()}
+
+    def search(self, query, corpora='user', drive_id=None, fields=None, page_token=None):
+        params = self.get_search_params(query, corpora, drive_id, fields)
+        results = []
+        while True:
+            response = self.service.files().list(**params, pageToken=page_token).execute()
+            results.extend(response.get('files', []))
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+        return results
+
+    def get_search_params(self, query, corpora='user', drive_id=None, fields=None):
+        params = {
+            'q': query,
+            'corpora': corpora,
+            'spaces': 'drive',
+            'supportsAllDrives': True,
+            'fields': fields,
+        }
+        if corpora != 'user':
+            params['includeItemsFromAllDrives'] = True
+        if drive_id:
+            params['driveId'] = drive_id
+        return params
+
+    def list_children_many(self, folders, fields=None):
+        # First pages in batch requests; any further pages one at a time.
+        requests = []
+        for folder_id, drive_id in folders:
+            corpora = 'drive' if drive_id else 'user'
+            params = self.get_search_params(get_children_query(folder_id), corpora, drive_id, fields)
+            requests.append((folder_id, self.service.files().list(**params)))
+        results = {}
+        for folder_id, (response, exception) in execute_batch(self.service, requests).items():
+            if exception:
+                results[folder_id] = exception
+                continue
+            children = response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if page_token:
+                drive_id = dict(folders).get(folder_id)
+                corpora = 'drive' if drive_id else 'user'
+                try:
+                    children.extend(self.search(get_children_query(folder_id), corpora, drive_id, fields, page_token))
+                except Exception as e:
+                    children = e
+            results[folder_id] = children
+        return results
+
+    def list_shared_drives(self, page_token=None):
+        results = []
+        while True:
+            response = self.service.drives().list(pageToken=page_token).execute()
+            results.extend(response.get('drives', []))
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+        return results
+
+    def move_item(self, item_id, add_parents, remove_parents):
+        return self.service.files().update(
+            fileId=item_id,
+            addParents=add_parents,
+            supportsAllDrives=True,
+            removeParents=remove_parents,
+        ).execute()
+
+    def create_item(self, metadata):
+        return self.service.files().create(
+            body=metadata,
+            supportsAllDrives=True,
+            fields='id',
+        ).execute()
+
+    def create_folders(self, folders):
+        requests = []
+        for new_id, name, parent_id in folders:
+            metadata = {'id': new_id, 'name': name, 'parents': [parent_id], 'mimeType': FOLDER_MIMETYPE}
+            request = self.service.files().create(body=metadata, supportsAllDrives=True, fields='id')
+            requests.append((new_id, request))
+        return {i: e for i, (r, e) in execute_batch(self.service, requests).items()}
+
+    def delete_item(self, item_id):
+        return self.service.files().delete(fileId=item_id, supportsAllDrives=True).execute()
+
+    def trash_item(self, item_id):
+        return self.service.files().update(fileId=item_id, body={'trashed': True}, supportsAllDrives=True).execute()
+
+    def trash_items(self, item_ids):
+        requests = []
+        for item_id in item_ids:
+            request = self.service.files().update(fileId=item_id, body={'trashed': True}, supportsAllDrives=True)
+            requests.append((item_id, request))
+        return {i: e for i, (r, e) in execute_batch(self.service, requests).items()}
+
+    def generate_ids(self, count):
+        response = self.service.files().generateIds(count=count, space='drive').execute()
+        return response.get('ids', [])
+
+    def transfer_ownership(self, item_id, permission_id):
+        return self.service.permissions().update(
+            fileId=item_id,
+            permissionId=permission_id,
+            body={'role': 'owner'},
+            supportsAllDrives=True,
+            transferOwnership=True,
+        ).execute()
+
+    def list_permissions(self, item_id, fields=None):
+        permissions = []
+        page_token = None
+        while True:
+            response = self.permissions_request(item_id, fields, page_token).execute()
+            permissions.extend(response.get('permissions', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return permissions
+
+    def get_permissions(self, item_ids, fields=None):
+        requests = [(i, self.permissions_request(i, fields)) for i in item_ids]
+        results = {}
+        for item_id, (response, exception) in execute_batch(self.service, requests).items():
+            if exception:
+                results[item_id] = exception
+            elif response.get('nextPageToken'):
+                # More than one page; list them all without batching.
+                try:
+                    results[item_id] = self.list_permissions(item_id, fields=fields)
+                except Exception as e:
+                    results[item_id] = e
+            else:
+                results[item_id] = response.get('permissions', [])
+        return results
+
+    def permissions_request(self, item_id, fields=None, page_token=None):
+        if fields is None:
+            fields = 'nextPageToken, permissions(id, type, role, emailAddress, domain)'
+        return self.service.permissions().list(
+            fileId=item_id,
+            supportsAllDrives=True,
+            pageSize=100,
+            pageToken=page_token,
+            fields=fields,
+        )
+
+    def get_start_page_token(self, drive_id=None):
+        params = {'supportsAllDrives': True}
+        if drive_id:
+            params['driveId'] = drive_id
+        response = self.service.changes().getStartPageToken(**params).execute()
+        return response.get('startPageToken')
+
+    def list_changes(self, page_token, drive_id=None, fields=None):
+        params = {
+            'spaces': 'drive',
+            'includeRemoved': True,
+            'includeItemsFromAllDrives': True,
+            'supportsAllDrives': True,
+            'pageSize': 1000,
+            'fields': fields,
+        }
+        if drive_id:
+            params['driveId'] = drive_id
+        changes = []
+        while True:
+            response = self.service.changes().list(**params, pageToken=page_token).execute()
+            changes.extend(response.get('changes', []))
+            if 'newStartPageToken' in response:
+                return changes, response.get('newStartPageToken')
+            page_token = response.get('nextPageToken')
+
+
+class MemoryBackend(DriveBackend):
+    """
+    In-memory Drive model, e.g. loaded from a snapshot, for running traversal
+    and move algorithms at memory speed. Returned items are copies.
+    """
+    def __init__(self, items=None, drives=None, user=None):
+        self.items = {i['id']: copy.deepcopy(i) for i in items or []}
+        self.drives = [copy.deepcopy(d) for d in drives or []]
+        self.user = user
+        # Ids of changed items, in order; a page token is an index into it.
+        self.changes = []
+        self.children = {}
+        for item in self.items.values():
+            for parent_id in item.get('parents', []):
+                self.children.setdefault(parent_id, []).append(item['id'])
+
+    @classmethod
+    def from_snapshot(cls, snapshot_file):
+        """Load a JSON snapshot of {"user": ..., "drives": [...], "items": [...]}."""
+        with open(snapshot_file) as f:
+            snapshot = json.load(f)
+        return cls(snapshot.get('items'), snapshot.get('drives'), snapshot.get('user'))
+
+    def save_snapshot(self, snapshot_file):
+        with open(snapshot_file, 'w') as f:
+            json.dump({'user': self.user, 'drives': self.drives, 'items': list(self.items.values())}, f)
+
+    def get_item(self, item_id, fields=None):
+        for drive in self.drives:
+            if drive['id'] == item_id:
+                # A shared drive's id is also the id of its root folder.
+                return {
+                    'id': item_id,
+                    'name': drive.get('name'),
+                    'mimeType': FOLDER_MIMETYPE,
+                    'driveId': item_id,
+                    'capabilities': {'canAddChildren': True},
+                }
+        if item_id not in self.items:
+            raise KeyError(f"File not found: {item_id}")
+        return copy.deepcopy(self.items[item_id])
+
+    def search(self, query, corpora='user', drive_id=None, fields=None, page_token=None):
+        match = parse_query(query)
+        in_parents = match.pop('in_parents', None)
+        if in_parents is not None:
+            candidates = [self.items[i] for i in self.children.get(in_parents, [])]
+        else:
+            candidates = self.items.values()
+        results = []
+        for item in candidates:
+            if corpora == 'user' and item.get('driveId'):
+                continue
+            if corpora == 'drive' and item.get('driveId') != drive_id:
+                continue
+            if all(item.get(k, False) == v for k, v in match.items()):
+                result = copy.deepcopy(item)
+                if result.get('driveId'):
+                    # Like files.list, leave out permissions of shared-drive items.
+                    result.pop('permissions', None)
+                results.append(result)
+        return results
+
+    def list_shared_drives(self, page_token=None):
+        return copy.deepcopy(self.drives)
+
+    def set_parent(self, item, parent_id):
+        for old_parent_id in item.get('parents', []):
+            self.children.get(old_parent_id, []).remove(item['id'])
+        item['parents'] = [parent_id]
+        self.children.setdefault(parent_id, []).append(item['id'])
+        self.changes.append(item['id'])
+        parent = self.items.get(parent_id, {})
+        drive_id = parent.get('driveId') or (parent_id if any(d['id'] == parent_id for d in self.drives) else None)
+        if drive_id:
+            item['driveId'] = drive_id
+        else:
+            item.pop('driveId', None)
+
+    def move_item(self, item_id, add_parents, remove_parents):
+        item = self.items[item_id]
+        self.set_parent(item, add_parents)
+        return {'id': item_id}
+
+    def create_item(self, metadata):
+        item = copy.deepcopy(metadata)
+        item.setdefault('id', uuid.uuid4().hex)
+        if item['id'] in self.items:
+            raise ValueError(f"Item already exists: {item['id']}")
+        parent_ids = item.pop('parents', [])
+        self.items[item['id']] = item
+        self.changes.append(item['id'])
+        if parent_ids:
+            self.set_parent(item, parent_ids[0])
+        return {'id': item['id']}
+
+    def delete_item(self, item_id):
+        if item_id not in self.items:
+            raise KeyError(f"File not found: {item_id}")
+        # Deleting a folder deletes its descendants too.
+        for child_id in list(self.children.pop(item_id, [])):
+            self.delete_item(child_id)
+        item = self.items.pop(item_id)
+        for parent_id in item.get('parents', []):
+            if item_id in self.children.get(parent_id, []):
+                self.children[parent_id].remove(item_id)
+        self.changes.append(item_id)
+        return ''
+
+    def trash_item(self, item_id):
+        self.items[item_id]['trashed'] = True
+        self.changes.append(item_id)
+        return {'id': item_id}
+
+    def generate_ids(self, count):
+        return [uuid.uuid4().hex for i in range(count)]
+
+    def list_permissions(self, item_id, fields=None):
+        if item_id not in self.items:
+            raise KeyError(f"File not found: {item_id}")
+        return copy.deepcopy(self.items[item_id].get('permissions', []))
+
+    def transfer_ownership(self, item_id, permission_id):
+        item = self.items[item_id]
+        for permission in item.get('permissions', []):
+            if permission.get('id') == permission_id:
+                permission['role'] = 'owner'
+                item['owners'] = [{'emailAddress': permission.get('emailAddress')}]
+                item['ownedByMe'] = permission.get('emailAddress') == self.user
+                return copy.deepcopy(permission)
+        raise KeyError(f"Permission not found: {permission_id}")
+
+    def get_start_page_token(self, drive_id=None):
+        return str(len(self.changes))
+
+    def list_changes(self, page_token, drive_id=None, fields=None):
+        changes = []
+        for item_id in self.changes[int(page_token):]:
+            change = {'fileId': item_id, 'removed': item_id not in self.items}
+            if not change['removed']:
+                change['file'] = copy.deepcopy(self.items[item_id])
+                if drive_id and change['file'].get('driveId') != drive_id:
+                    continue
+            changes.append(change)
+        return changes, str(len(self.changes))
+
+
+def get_children_query(folder_id):
+    # Trashed items keep their parents, e.g. source folders emptied by a move.
+    return f"'{folder_id}' in parents and not trashed"
+
+# Clauses of the files.list queries used by DriveSensibly.
+QUERY_CLAUSES = [
+    (re.compile(r"^'((?:[^'\\]|\\.)*)' in parents$"), 'in_parents'),
+    (re.compile(r"^name = '((?:[^'\\]|\\.)*)'$"), 'name'),
+    (re.compile(r"^mimeType = '((?:[^'\\]|\\.)*)'$"), 'mimeType'),
+]
+
+# Quoted strings, with escaped quotes, or " and " between clauses.
+QUERY_TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\s+and\s+")
+
+def split_query(query):
+    """Split a query at "and" outside of quoted strings."""
+    clauses = []
+    start = 0
+    for m in QUERY_TOKEN_RE.finditer(query):
+        if not m.group().startswith("'"):
+            clauses.append(query[start:m.start()].strip())
+            start = m.end()
+    clauses.append(query[start:].strip())
+    return clauses
+
+def parse_query(query):
+    """Parse a files.list query into a dict of field: value to match."""
+    match = {}
+    for clause in split_query(query):
+        clause = clause.strip()
+        if clause == 'not trashed' or clause == 'trashed = false':
+            match['trashed'] = False
+            continue
+        for pattern, field in QUERY_CLAUSES:
+            m = pattern.match(clause)
+            if m:
+                match[field] = m.group(1).replace("\\'", "'")
+                break
+        else:
+            raise ValueError(f"Unsupported query: {clause}")
+    return match
+
+def get_backend(service):
+    """Get the DriveBackend for "service", which may already be one."""
+    if isinstance(service, DriveBackend):
+        return service
+    return ServiceBackend(service)
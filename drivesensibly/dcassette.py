@@ -0,0 +1,161 @@
+import base64
+import json
+import logging
+import re
+import threading
+import time
+
+from collections import deque
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+import httplib2
+
+
+# Query parameters and headers that must never be saved in a cassette.
+REDACTED_PARAMS = ['access_token', 'key', 'oauth_token', 'refresh_token', 'client_secret', 'id_token']
+REDACTED_HEADERS = ['authorization', 'set-cookie', 'x-goog-api-key']
+# Authorization headers inside multipart (batch) request bodies.
+AUTH_HEADER_RE = re.compile(rb'(?im)^(authorization:[ \t]*)[^\r\n]+')
+# OAuth secrets in JSON and form-encoded bodies.
+SECRET_FIELDS = rb'(?:access_token|refresh_token|client_secret|id_token)'
+SECRET_JSON_RE = re.compile(rb'("' + SECRET_FIELDS + rb'"\s*:\s*)"[^"]*"')
+SECRET_FORM_RE = re.compile(rb'((?:^|&)' + SECRET_FIELDS + rb'=)[^&\s]*')
+# Hosts of OAuth token requests, e.g. refreshes made through AuthorizedHttp;
+# these aren't recorded at all.
+TOKEN_HOSTS = ['oauth2.googleapis.com', 'accounts.google.com', 'www.googleapis.com/oauth2']
+
+
+class CassetteError(Exception):
+    pass
+
+
+def redact_uri(uri):
+    parsed = urlparse(uri)
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if k not in REDACTED_PARAMS]
+    return parsed._replace(query=urlencode(query)).geturl()
+
+def is_token_request(uri):
+    parsed = urlparse(uri)
+    return any(f"{parsed.hostname}{parsed.path}".startswith(h) for h in TOKEN_HOSTS)
+
+def redact_body(body):
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    body = AUTH_HEADER_RE.sub(rb'\1REDACTED', body)
+    body = SECRET_JSON_RE.sub(rb'\1"REDACTED"', body)
+    return SECRET_FORM_RE.sub(rb'\1REDACTED', body)
+
+def encode_content(content):
+    """Save content as text if possible, otherwise as base64."""
+    if content is None:
+        return None, None
+    try:
+        return content.decode('utf-8'), 'text'
+    except UnicodeDecodeError:
+        return base64.b64encode(content).decode('ascii'), 'base64'
+
+def decode_content(content, encoding):
+    if content is None:
+        return b''
+    if encoding == 'base64':
+        return base64.b64decode(content)
+    return content.encode('utf-8')
+
+
+class RecordingHttp(object):
+    """Wrap an httplib2.Http object, saving every request/response pair."""
+    def __init__(self, http, cassette_path):
+        self.http = http
+        self.cassette_path = cassette_path
+        self.interactions = []
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def wrap(self, http):
+        """Get a recorder of "http" that saves to this cassette, e.g. for another thread."""
+        recorder = RecordingHttp(http, self.cassette_path)
+        recorder.interactions = self.interactions
+        recorder.lock = self.lock
+        return recorder
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        start = time.perf_counter()
+        response, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        latency = time.perf_counter() - start
+        if is_token_request(uri):
+            # Token requests and responses carry credentials; replay doesn't need them.
+            return response, content
+        request_body, request_encoding = encode_content(redact_body(body))
+        response_body, response_encoding = encode_content(redact_body(content))
+        interaction = {
+            'request': {
+                'method': method,
+                'uri': redact_uri(uri),
+                'body': request_body,
+                'encoding': request_encoding,
+            },
+            'response': {
+                'status': response.status,
+                'headers': {k: v for k, v in response.items() if k.lower() not in REDACTED_HEADERS},
+                'body': response_body,
+                'encoding': response_encoding,
+            },
+            'latency': round(latency, 4),
+        }
+        with self.lock:
+            self.interactions.append(interaction)
+        return response, content
+
+    def save(self):
+        with open(self.cassette_path, 'w') as f:
+            json.dump({'version': 1, 'interactions': self.interactions}, f, indent=1)
+        logging.info(f"{len(self.interactions)} API requests recorded to \"{self.cassette_path}\".")
+
+
+class ReplayHttp(object):
+    """
+    Serve the responses saved in a cassette, in recorded order for each method
+    and uri, optionally waiting for the recorded latency of each request.
+    """
+    def __init__(self, cassette_path, latency=False):
+        with open(cassette_path) as f:
+            cassette = json.load(f)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.interactions = {}
+        for interaction in cassette.get('interactions', []):
+            key = self.get_key(interaction['request']['method'], interaction['request']['uri'])
+            self.interactions.setdefault(key, deque()).append(interaction)
+        # Attributes expected of an httplib2.Http object.
+        self.timeout = None
+        self.redirect_codes = httplib2.Http().redirect_codes
+
+    def wrap(self, http):
+        """Serve this cassette in place of "http"; requests are served thread-safely."""
+        return self
+
+    def get_key(self, method, uri):
+        return (method, redact_uri(uri))
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        key = self.get_key(method, uri)
+        with self.lock:
+            queue = self.interactions.get(key)
+            if not queue:
+                raise CassetteError(f"No recorded response for {method} {key[1]}")
+            interaction = queue.popleft()
+        if self.latency:
+            time.sleep(interaction.get('latency', 0))
+        recorded = interaction['response']
+        info = {**recorded['headers'], 'status': str(recorded['status'])}
+        content = decode_content(recorded['body'], recorded['encoding'])
+        return httplib2.Response(info), content
+
+    def close(self):
+        pass
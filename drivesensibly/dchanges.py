@@ -0,0 +1,261 @@
+import json
+import logging
+
+from datetime import datetime
+from datetime import timezone
+from pathlib import Path
+
+import dbackend
+import dprogress
+import dutils
+import dwalk
+
+CHANGE_FIELDS = 'nextPageToken, newStartPageToken, changes(fileId, removed, \
+    file(id, name, mimeType, parents, driveId, trashed, createdTime))'
+FOLDER_FIELDS = 'nextPageToken, files(id, name, mimeType, parents, driveId)'
+
+
+def get_state_path(log_path):
+    """Get the state file saved next to the log file of a listing."""
+    return Path(log_path).with_suffix('.state.json')
+
+def start_state(service, folder):
+    """
+    Get a new state for "folder" with the current Changes API token, or None
+    if no token is available; the listing itself doesn't need one.
+    """
+    error = None
+    try:
+        token = dbackend.get_backend(service).get_start_page_token(folder.get('driveId'))
+    except Exception as e:
+        error = e
+        token = None
+    if not token:
+        logging.warning(f"No changes token available ({error!r}); listing state not saved for --since.")
+        return None
+    return get_new_state(folder, token)
+
+def get_new_state(folder, token):
+    return {
+        'token': token,
+        'time': datetime.now(tz=timezone.utc).isoformat(),
+        'folder': {'id': folder.get('id'), 'name': folder.get('name'), 'driveId': folder.get('driveId')},
+        # Compact tree of id: [name, parent id, is folder].
+        'items': {},
+    }
+
+def add_snapshot_item(snapshot, item, parents):
+    parent_id = parents[-1].get('id') if parents else None
+    snapshot[item.get('id')] = [item.get('name'), parent_id, int(dutils.item_is_folder(item))]
+
+def get_index_path(log_dir):
+    return Path(log_dir) / 'states.json'
+
+def get_index_entry(state):
+    return {
+        'token': state.get('token'),
+        'folder': state.get('folder', {}).get('id'),
+        'item_ct': len(state.get('items', {})),
+    }
+
+def load_index(log_dir):
+    """
+    Get the index of the states saved in "log_dir", by state file name, so
+    that lookups don't have to parse every snapshot; state files missing from
+    it (e.g. saved before it existed) are read once and added.
+    """
+    index_path = get_index_path(log_dir)
+    index = {}
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        pass
+    state_files = {p.name: p for p in Path(log_dir).glob('*.state.json')}
+    missing = set(state_files) - set(index)
+    for name in sorted(missing):
+        try:
+            with open(state_files[name]) as f:
+                index[name] = get_index_entry(json.load(f))
+        except (OSError, ValueError):
+            missing.discard(name)
+    # Forget states whose files were deleted.
+    removed = set(index) - set(state_files)
+    for name in removed:
+        del index[name]
+    if missing or removed:
+        save_index(index, log_dir)
+    return index
+
+def save_index(index, log_dir):
+    try:
+        with open(get_index_path(log_dir), 'w') as f:
+            json.dump(index, f)
+    except OSError as e:
+        logging.warning(f"Listing state index not saved: {e}")
+
+def save_state(state, state_file):
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
+    logging.debug(f"Listing state saved to \"{state_file}\".")
+    log_dir = Path(state_file).parent
+    index = load_index(log_dir)
+    index[Path(state_file).name] = get_index_entry(state)
+    save_index(index, log_dir)
+
+def find_state(since, log_dir):
+    """
+    Load the state saved by an earlier listing, given its log file, its state
+    file, or its Changes API token.
+    """
+    path = Path(since)
+    if path.is_file() and path.suffix != '.json':
+        path = get_state_path(path)
+    if path.is_file():
+        with open(path) as f:
+            return json.load(f)
+    # Look for the most recent state saved with this token.
+    index = load_index(log_dir)
+    for name in sorted(index, reverse=True):
+        if index[name].get('token') == since:
+            with open(Path(log_dir) / name) as f:
+                return json.load(f)
+    logging.error(f"Error: No saved listing found for \"{since}\".")
+    exit(1)
+
+def get_item_count(log_dir, folder_id):
+    """Get the number of items of the latest saved listing of a folder, if any."""
+    index = load_index(log_dir)
+    for name in sorted(index, reverse=True):
+        if index[name].get('folder') == folder_id:
+            return index[name].get('item_ct')
+    return None
+
+def get_changes(service, token, drive_id=None):
+    try:
+        return dbackend.get_backend(service).list_changes(token, drive_id=drive_id, fields=CHANGE_FIELDS)
+    except Exception as e:
+        logging.error(e)
+        exit(1)
+
+def get_path(items, item_id):
+    names = []
+    while item_id in items:
+        name, item_id, is_folder = items[item_id]
+        names.append(name)
+    return ' > '.join(reversed(names))
+
+def get_items_under(items, root_id):
+    """Get the ids in "items" whose parents lead up to "root_id"."""
+    under = {root_id: root_id in items}
+    for item_id in items:
+        chain = []
+        while item_id not in under:
+            # Marked False until resolved, which also stops parent loops.
+            under[item_id] = False
+            chain.append(item_id)
+            item_id = items.get(item_id, [None, None])[1]
+            if item_id is None:
+                break
+        result = under.get(item_id, False)
+        for i in chain:
+            under[i] = result
+    return {i for i, is_under in under.items() if is_under and i in items}
+
+def get_folder_children(service, folder):
+    shared_drive = {'id': folder.get('driveId')} if folder.get('driveId') else None
+    return dutils.get_children(service, folder.get('id'), shared_drive=shared_drive, fields=FOLDER_FIELDS)
+
+def apply_changes(service, state, changes):
+    """
+    Get the state's items updated by "changes", adding the contents of folders
+    moved in from outside the tree.
+    """
+    items = dict(state['items'])
+    root_id = state['folder']['id']
+    since = datetime.fromisoformat(state['time'])
+    changed = {}
+    for change in changes:
+        # The last change of an item is its current state.
+        changed[change.get('fileId')] = change
+    for item_id, change in changed.items():
+        item = change.get('file')
+        if change.get('removed') or not item or item.get('trashed'):
+            items.pop(item_id, None)
+        elif item_id == root_id:
+            items[item_id] = [item.get('name'), None, 1]
+        else:
+            parents = item.get('parents', [])
+            items[item_id] = [item.get('name'), parents[0] if parents else None, int(dutils.item_is_folder(item))]
+
+    # Folders that were moved into the tree bring unchanged items with them.
+    under = get_items_under(items, root_id)
+    for item_id, change in changed.items():
+        item = change.get('file')
+        if item_id not in under or item_id in state['items'] or not dutils.item_is_folder(item):
+            continue
+        created = datetime.fromisoformat(item.get('createdTime', state['time']).replace('Z', '+00:00'))
+        if created > since:
+            # New folders' contents are new too, so they're among the changes.
+            continue
+
+        def add_item(child, parents):
+            if parents:
+                add_snapshot_item(items, child, parents)
+
+        dwalk.walk_tree(
+            item,
+            lambda folder: get_folder_children(service, folder),
+            pre_visit=add_item,
+            get_children_many=lambda folders: dutils.get_children_many(service, folders, fields=FOLDER_FIELDS),
+        )
+    return items
+
+def run_list_changes(user, service, folder, state, state_file=None):
+    """List what was added, removed, renamed or moved under "folder" since "state"."""
+    if state['folder']['id'] != folder.get('id'):
+        logging.error(f"Error: The saved listing is of \"{state['folder']['name']}\", not \"{folder.get('name')}\".")
+        exit(1)
+    progress = dprogress.Progress()
+    dprogress.track_requests(service, progress)
+    changes, token = get_changes(service, state['token'], folder.get('driveId'))
+    new_state = get_new_state(folder, token)
+    items = apply_changes(service, state, changes)
+    progress.finish()
+
+    old_items = state['items']
+    under = get_items_under(items, folder.get('id'))
+    new_state['items'] = {i: items[i] for i in under}
+    lines = []
+    counts = {'added_ct': 0, 'removed_ct': 0, 'renamed_ct': 0, 'moved_ct': 0}
+    for item_id in under - set(old_items):
+        lines.append(('added', get_path(items, item_id)))
+    for item_id in set(old_items) - under:
+        lines.append(('removed', get_path(old_items, item_id)))
+    for item_id in under & set(old_items):
+        name, parent_id, is_folder = items[item_id]
+        old_name, old_parent_id, old_is_folder = old_items[item_id]
+        if parent_id != old_parent_id:
+            lines.append(('moved', f"{get_path(old_items, item_id)} -> {get_path(items, item_id)}"))
+        elif name != old_name:
+            lines.append(('renamed', f"{get_path(old_items, item_id)} -> {get_path(items, item_id)}"))
+    for change, text in sorted(lines, key=lambda line: line[1]):
+        counts[f"{change}_ct"] += 1
+        logging.info(f"{change}\t{text}")
+    if state_file:
+        save_state(new_state, state_file)
+
+    # Print summary.
+    counts['total_ct'] = len(under)
+    counts['folder_ct'] = len([i for i in under if items[i][2]])
+    folder_ct = counts['folder_ct']
+    file_ct = counts['total_ct'] - folder_ct
+    # Ensure proper plurals.
+    d = '' if folder_ct == 1 else 's'
+    f = '' if file_ct == 1 else 's'
+    dutils.eprint(f"\nTotal: {folder_ct} folder{d} and {file_ct} file{f}.")
+    dutils.eprint(
+        f"Changes: {counts['added_ct']} added, {counts['removed_ct']} removed, "
+        f"{counts['renamed_ct']} renamed, {counts['moved_ct']} moved."
+    )
+    return counts
@@ -1,4 +1,10 @@
+import logging
+
+import dbackend
+import dprogress
+import dshard
 import dutils
+import dwalk
 
 
 def change_item_owner(service, item, new_owner):
@@ -21,7 +27,7 @@ def change_item_owner(service, item, new_owner):
         {'id': '15FeyUKN7RF_FnG_dLcVg0az5-MNd6nPL', 'name': 'Monday Feb 22 LP.pdf', 'mimeType': 'application/vnd.google-apps.shortcut', 'parents': ['1-1mFkhE4b2h1caLcIE_wUTkcCFphxzO9'], 'modifiedTime': '2021-05-04T09:57:42.427Z', 'owners': [{'kind': 'drive#user', 'displayName': 'IT Admin CAR', 'me': True, 'permissionId': '02558864029776463543', 'emailAddress': 'it_admin_car@sil.org'}], 'ownedByMe': True}
         '''
         #body = {'owners': owners.append()}
-        print(f"Can't change owner of shortcut \"{item.get('name')}\".")
+        logging.warning(f"Can't change owner of shortcut \"{item.get('name')}\".")
         return False
         
     # Transfer ownership.
@@ -30,35 +36,93 @@ def change_item_owner(service, item, new_owner):
         account = permission.get('emailAddress', None)
         if account == new_owner:
             # Set this account as owner.
-            updated_permission = {'role': 'owner'}
             try:
-                result = service.permissions().update(
-                    fileId=item['id'],
-                    permissionId=permission['id'],
-                    body=updated_permission,
-                    supportsAllDrives=True,
-                    transferOwnership=True,
-                ).execute()
+                result = dbackend.get_backend(service).transfer_ownership(item['id'], permission['id'])
                 return True
             except Exception as e:
-                print(f"Error: {e}")
+                logging.error(e)
                 return False
 
-def change_owner_recursively(service, item, new_owner, parents=list()):
-    # Handle item.
+def change_owner_recursively(service, item, new_owner, parents=None, progress=None, output=None, counts=None):
+    if parents is None:
+        parents = [item['name']]
+    if output is None:
+        output = logging.info
+    if counts is None:
+        counts = {}
+    counts.update({'total_ct': 0, 'failed_ct': 0})
+    # Names of the folders above "item"; the walker's parents start at item.
+    base_names = parents[:-1]
+
+    def get_folder_children(folder):
+        return dutils.get_children(service, folder['id'])
+
+    def change_owner(child, child_parents):
+        names = [*base_names, *[p['name'] for p in child_parents], child['name']]
+        output(change_owner_line(service, child, new_owner, names, counts))
+
+    dwalk.walk_tree(
+        item,
+        get_folder_children,
+        pre_visit=change_owner,
+        progress=progress,
+        get_children_many=lambda folders: dutils.get_children_many(service, folders),
+    )
+    return counts
+
+def change_owner_line(service, item, new_owner, names, counts):
     result = change_item_owner(service, item, new_owner)
+    counts['total_ct'] += 1
+    if not result:
+        counts['failed_ct'] += 1
     x = '\u2713' if result else '\u2717'
-    print(f"{x} {' > '.join(parents)}")
+    return f"{x} {' > '.join(names)}"
+
+def change_owner_shard(args, output, counts):
+    """Change owner of a subfolder's tree in a worker process."""
+    folder, new_owner, parents = args
+    change_owner_recursively(dshard.worker_service, folder, new_owner, parents, output=output, counts=counts)
 
-    # Handle item's children.
-    if dutils.item_is_folder(item):
-        children = dutils.get_children(service, item['id'])
-        for child in children:
-            new_parents = [*parents, child['name']]
-            change_owner_recursively(service, child, new_owner, new_parents)
+def change_owner_sharded(service, folder, new_owner, processes=1, progress=None):
+    # Handle the top folder and its files here and its subfolders in worker processes.
+    counts = {'total_ct': 0, 'failed_ct': 0}
+    logging.info(change_owner_line(service, folder, new_owner, [folder['name']], counts))
+    children = dutils.get_children(service, folder['id'])
+    subfolders = [c for c in children if dutils.item_is_folder(c)]
+    shard_args = [(f, new_owner, [folder['name'], f['name']]) for f in subfolders]
+    shards = dshard.imap_shards(service, change_owner_shard, shard_args, processes)
+    if progress:
+        progress.add_discovered(len(children) + 1)
+        progress.add_processed()
+    for child in children:
+        if not dutils.item_is_folder(child):
+            logging.info(change_owner_line(service, child, new_owner, [folder['name'], child['name']], counts))
+            if progress:
+                progress.add_processed()
+            continue
+        lines, shard_counts, result, error = next(shards)
+        dshard.add_shard_result(child, lines, shard_counts, error, counts)
+        if progress:
+            progress.add_discovered(shard_counts.get('total_ct', 0) - 1)
+            progress.add_processed(shard_counts.get('total_ct', 0))
+    return counts
 
-def run_change_owner(user, service, folder, new_owner, show_already_owned=True):
+def run_change_owner(user, service, folder, new_owner, show_already_owned=True, processes=1):
     # Process folder.
     folder_id = folder.get('id', None)
-    print(f"Changing owner of \"{folder['name']}\" to \"{new_owner}\"...")
-    change_owner_recursively(service, folder, new_owner, [folder['name']])
+    logging.info(f"Changing owner of \"{folder['name']}\" to \"{new_owner}\"...")
+    progress = dprogress.Progress()
+    dprogress.track_requests(service, progress)
+    if processes > 1:
+        counts = change_owner_sharded(service, folder, new_owner, processes=processes, progress=progress)
+    else:
+        counts = change_owner_recursively(service, folder, new_owner, [folder['name']], progress=progress)
+    progress.finish()
+    # Print summary.
+    total_ct = counts['total_ct']
+    failed_ct = counts['failed_ct']
+    i = '' if total_ct == 1 else 's'
+    dutils.eprint(f"\nTotal: {total_ct} item{i}, {failed_ct} not changed.")
+    if counts.get('error_ct'):
+        dutils.eprint(f"{counts['error_ct']} subfolder(s) not fully handled because of errors; see log.")
+    return counts
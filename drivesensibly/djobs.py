@@ -0,0 +1,257 @@
+import csv
+import json
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httplib2
+
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from google_auth_httplib2 import AuthorizedHttp
+
+import dchown
+import dlist
+import dlog
+import dmove
+import dprogress
+import dutils
+
+# Jobs run at the same time.
+MAX_JOB_THREADS = 8
+# Requests per second allowed across all jobs.
+MAX_REQUESTS_PER_SECOND = 50
+# Actions allowed in a jobs file, and whether they need an argument.
+ACTIONS = {
+    'list': False,
+    'list-details': False,
+    'chown': True,
+    'move': True,
+}
+
+
+class RateLimiter(object):
+    """Token bucket shared by all threads."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def build_service(credentials, rate=MAX_REQUESTS_PER_SECOND, wrap_http=None):
+    """
+    Build a Drive service that can be shared by several threads: each thread
+    gets its own HTTP object, and all requests go through one rate limiter.
+    "wrap_http", if given, wraps each thread's HTTP object, e.g. to record it;
+    functions added later to the service's "ds_http_hooks" are called with
+    each new thread's authorized HTTP object, e.g. to time its requests.
+    """
+    limiter = RateLimiter(rate)
+    local = threading.local()
+    http_hooks = []
+
+    def get_http():
+        if not hasattr(local, 'http'):
+            http = httplib2.Http()
+            if wrap_http:
+                http = wrap_http(http)
+            local.http = AuthorizedHttp(credentials, http=http) if credentials else http
+            for hook in http_hooks:
+                hook(local.http)
+        return local.http
+
+    class LimitedHttpRequest(HttpRequest):
+        def execute(self, http=None, num_retries=0):
+            limiter.acquire()
+            return super().execute(http=http, num_retries=num_retries)
+
+    def build_request(http, *args, **kwargs):
+        return LimitedHttpRequest(get_http(), *args, **kwargs)
+
+    class LimitedBatchHttpRequest(object):
+        """Batch request that waits for a token per call, as each call counts against quota."""
+        def __init__(self, batch):
+            self.batch = batch
+            self.size = 0
+
+        def add(self, *args, **kwargs):
+            self.size += 1
+            return self.batch.add(*args, **kwargs)
+
+        def execute(self, http=None):
+            for i in range(self.size):
+                limiter.acquire()
+            return self.batch.execute(http=http)
+
+    service = build('drive', 'v3', requestBuilder=build_request, http=get_http())
+    new_batch_http_request = service.new_batch_http_request
+    service.new_batch_http_request = lambda *args, **kwargs: LimitedBatchHttpRequest(
+        new_batch_http_request(*args, **kwargs)
+    )
+    service.ds_http_hooks = http_hooks
+    return service
+
+def read_jobs(jobs_file):
+    """Read jobs from a YAML, JSON or CSV file of action, folder and arg."""
+    path = Path(jobs_file)
+    suffix = path.suffix.lower()
+    with open(path, newline='') as f:
+        if suffix in ['.yaml', '.yml']:
+            try:
+                import yaml
+            except ImportError:
+                logging.error("PyYAML is needed to read YAML job files.")
+                exit(1)
+            entries = yaml.safe_load(f)
+        elif suffix == '.json':
+            entries = json.load(f)
+        else:
+            rows = [r for r in csv.reader(f) if r and not r[0].strip().startswith('#')]
+            if rows and rows[0][0].strip().lower() == 'action':
+                # Skip header row.
+                rows = rows[1:]
+            entries = [dict(zip(['action', 'folder', 'arg'], r)) for r in rows]
+
+    jobs = []
+    for i, entry in enumerate(entries or []):
+        job = {
+            'num': i + 1,
+            'action': str(entry.get('action') or '').strip().lower(),
+            'folder': str(entry.get('folder') or '').strip().strip('"'),
+            'arg': str(entry.get('arg') or '').strip() or None,
+        }
+        error = None
+        if job['action'] not in ACTIONS:
+            error = f"unknown action \"{job['action']}\""
+        elif not job['folder']:
+            error = "no folder given"
+        elif ACTIONS[job['action']] and not job['arg']:
+            error = f"no argument given for \"{job['action']}\""
+        job['error'] = error
+        jobs.append(job)
+    return jobs
+
+
+class JobRunner(object):
+    """Run jobs concurrently with one shared service and folder cache."""
+    def __init__(self, user, service, log_path, threads=MAX_JOB_THREADS):
+        self.user = user
+        self.service = service
+        self.log_path = log_path
+        self.threads = threads
+        self.folders = {}
+        self.folders_lock = threading.Lock()
+
+    def find_folder(self, folder_string, all_drives=False):
+        """Find a single folder by name or "A > B > C" path, without prompting."""
+        key = (folder_string, all_drives)
+        with self.folders_lock:
+            if key in self.folders:
+                return self.folders[key]
+        path_names = [n.strip() for n in folder_string.split('>')]
+        if len(path_names) > 1:
+            items = dutils.expand_path_names_to_items(self.service, path_names)
+            results = items[-1:] if items else []
+        else:
+            name_escaped = path_names[0].replace("'", "\\'")
+            q = f"name = '{name_escaped}' and not trashed and \
+                mimeType = 'application/vnd.google-apps.folder'"
+            if all_drives:
+                results = dutils.get_all_drive_search_results(self.service, q)
+            else:
+                results = dutils.get_user_drive_search_results(self.service, q)
+        folder = None
+        if len(results) == 1 and dutils.item_is_folder(results[0]):
+            folder = results[0]
+        elif len(results) > 1:
+            logging.error(f"{len(results)} folders found for \"{folder_string}\"; give its full path.")
+        with self.folders_lock:
+            self.folders[key] = folder
+        return folder
+
+    def run_job(self, job):
+        name = f"job{job['num']}"
+        threading.current_thread().name = name
+        handler = logging.FileHandler(self.log_path.with_name(f"{self.log_path.stem}-{name}.log"))
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.setLevel(logging.INFO)
+        handler.addFilter(dlog.ThreadOnly(name))
+        logging.getLogger().addHandler(handler)
+
+        result = {'status': 'failed', 'counts': None}
+        try:
+            if job['error']:
+                logging.error(f"Job {job['num']}: {job['error']}.")
+                return result
+            all_drives = job['action'] in ['list', 'list-details']
+            folder = self.find_folder(job['folder'], all_drives=all_drives)
+            if not folder:
+                logging.error(f"Job {job['num']}: folder \"{job['folder']}\" not found in {self.user}'s Drive.")
+                return result
+            logging.info(f"{job['action']}, account: {self.user}, item: \"{folder.get('name')}\" ({folder.get('id')})")
+            if job['action'] == 'list':
+                counts = dlist.run_list_files(self.user, self.service, folder)
+            elif job['action'] == 'list-details':
+                counts = dlist.run_list_files(self.user, self.service, folder, True)
+            elif job['action'] == 'chown':
+                counts = dchown.run_change_owner(self.user, self.service, folder, job['arg'])
+            elif job['action'] == 'move':
+                counts = dmove.run_move_folder(self.user, self.service, folder, job['arg'])
+                if counts == 1:
+                    return result
+            result = {'status': 'done', 'counts': counts}
+            if get_counts_text(counts):
+                # Totals are only printed to stderr, so add them to the job's log.
+                logging.info(f"Total: {get_counts_text(counts)}.")
+        except (Exception, SystemExit) as e:
+            # Errors in one job shouldn't stop the others.
+            logging.error(f"Job {job['num']}: {e!r}")
+        finally:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+        return result
+
+    def run(self, jobs):
+        # Several jobs share stderr, so don't show live progress.
+        dprogress.Progress.enabled = False
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = list(executor.map(self.run_job, jobs))
+        self.log_summary(jobs, results)
+        return results
+
+    def log_summary(self, jobs, results):
+        failed_ct = len([r for r in results if r['status'] != 'done'])
+        logging.info(f"\nJobs: {len(jobs) - failed_ct} done, {failed_ct} failed.")
+        for job, result in zip(jobs, results):
+            details = get_counts_text(result['counts'])
+            details = f" ({details})" if details else ''
+            arg = f" -> \"{job['arg']}\"" if job['arg'] else ''
+            logging.info(f"   {job['num']}. {job['action']} \"{job['folder']}\"{arg}: {result['status']}{details}")
+
+def get_counts_text(counts):
+    if isinstance(counts, dict) and 'folder_ct' in counts:
+        return f"{counts['folder_ct']} folders, {counts['total_ct'] - counts['folder_ct']} files"
+    elif isinstance(counts, dict) and 'failed_ct' in counts:
+        return f"{counts['total_ct']} items, {counts['failed_ct']} not changed"
+    return ''
+
+def run_jobs(user, service, jobs_file, log_path):
+    jobs = read_jobs(jobs_file)
+    logging.info(f"{len(jobs)} jobs read from \"{jobs_file}\".")
+    return JobRunner(user, service, log_path).run(jobs)
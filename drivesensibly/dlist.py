@@ -1,67 +1,153 @@
+import heapq
 import logging
 
+from pathlib import Path
+
+import dchanges
+import dprogress
+import dshard
 import dutils
+import dwalk
 
 
-def list_parents_recursively(service, item, parents=None):
-    if parents is None:
-        parents = []
-    parents1_ids = item.get('parents', [])
-    if len(parents1_ids) > 0:
-        parents1 = []
-        for p_id in parents1_ids:
-            try:
-                p = service.files().get(
-                    fileId=p_id,
-                    supportsAllDrives=True,
-                    fields='id, name, mimeType, parents',
-                ).execute()
-            except Exception as e:
-                logging.error(e)
-                exit(1)
-            parents1.append(p)
-        # [-- Assuming 1st list item for now.
-        # parents1.sort() # can't sort list of dictionaries
-        parent = parents1[0]
-        # --]
-        parents.append(parent)
-        list_parents_recursively(service, parent, parents)
-    return parents
-
-def list_files_recursively(user, service, folder, parents=list(), counts=dict(), details=False):
-    pars = [p['name'] for p in parents]
-    details_text = dutils.get_details_text(details, folder, user)
-    # print(f"{' > '.join([*pars])}{details_text}")
-    logging.info(f"{' > '.join([*pars])}{details_text}")
-
-    # Get folder children.
+def get_folder_children(service, folder, fields=None):
     if folder.get('driveId'):
-        shared_drive = dutils.get_drive_item(service, folder.get('driveId'))
-        children = dutils.get_children(service, folder.get('id'), shared_drive=shared_drive)
-    else:
-        children = dutils.get_children(service, folder.get('id'))
+        # Only the shared drive's id is needed for the search.
+        shared_drive = {'id': folder.get('driveId')}
+        return dutils.get_children(service, folder.get('id'), shared_drive=shared_drive, fields=fields)
+    return dutils.get_children(service, folder.get('id'), fields=fields)
+
+def get_item_line(user, item, parents, details=False):
+    pars = [*[p['name'] for p in parents], item.get('name')]
+    details_text = dutils.get_details_text(details, item, user)
+    return f"{' > '.join(pars)}{details_text}"
+
+def list_files_recursively(user, service, folder, parents=None, counts=None, details=False, progress=None, output=None, snapshot=None):
+    if parents is None:
+        parents = [folder]
+    if counts is None:
+        counts = {'total_ct': 0, 'folder_ct': 0}
+    if output is None:
+        output = logging.info
+    # Folders above "folder"; the walker's parents start at folder.
+    base_parents = parents[:-1]
+
+    def list_item(item, item_parents):
+        if item_parents:
+            # The top folder is counted by the caller.
+            counts['total_ct'] += 1
+            if dutils.item_is_folder(item):
+                counts['folder_ct'] += 1
+        output(get_item_line(user, item, [*base_parents, *item_parents], details=details))
+        if snapshot is not None:
+            dchanges.add_snapshot_item(snapshot, item, [*base_parents, *item_parents])
+
+    dwalk.walk_tree(
+        folder,
+        lambda item: get_folder_children(service, item),
+        pre_visit=list_item,
+        progress=progress,
+        get_children_many=lambda items: dutils.get_children_many(service, items),
+    )
+    return counts
+
+def get_tree_signatures(service, folder, progress=None):
+    """
+    Get a dict of each item's path relative to "folder" to a sorted list of
+    (mimeType, size, md5Checksum) of the items at that path, in one listing.
+    """
+    fields = 'nextPageToken, files(id, name, mimeType, driveId, size, md5Checksum)'
+    signatures = {}
+    dwalk.walk_tree(
+        folder,
+        lambda item: get_folder_children(service, item, fields=fields),
+        pre_visit=lambda item, parents: add_signature(signatures, item, parents),
+        progress=progress,
+        get_children_many=lambda items: dutils.get_children_many(service, items, fields=fields),
+    )
+    sort_signatures(signatures)
+    return signatures
+
+def add_signature(signatures, item, parents):
+    """Add an item seen by dwalk.walk_tree to a get_tree_signatures dict."""
+    if not parents:
+        return
+    path = ' > '.join([*[p['name'] for p in parents[1:]], item.get('name')])
+    signature = (item.get('mimeType'), item.get('size'), item.get('md5Checksum'))
+    signatures.setdefault(path, []).append(signature)
+
+def sort_signatures(signatures):
+    for path_signatures in signatures.values():
+        path_signatures.sort(key=str)
 
+def list_shard(args, output, counts):
+    """List a subfolder's tree in a worker process; returns its snapshot entries."""
+    user, folder, parents, details, snapshot = args
+    counts.update({'total_ct': 0, 'folder_ct': 0})
+    list_files_recursively(user, dshard.worker_service, folder, parents, counts, details=details, output=output, snapshot=snapshot)
+    return snapshot
+
+def list_files_sharded(user, service, folder, counts, details=False, processes=1, progress=None, snapshot=None):
+    # List the top folder's files here and its subfolders in worker processes.
+    logging.info(get_item_line(user, folder, [], details=details))
+    if snapshot is not None:
+        dchanges.add_snapshot_item(snapshot, folder, [])
+    children = get_folder_children(service, folder)
+    subfolders = [c for c in children if dutils.item_is_folder(c)]
+    # Each shard collects its own snapshot entries, merged below.
+    shard_args = [(user, f, [folder, f], details, {} if snapshot is not None else None) for f in subfolders]
+    shards = dshard.imap_shards(service, list_shard, shard_args, processes)
+    if progress:
+        progress.add_discovered(len(children))
     for child in children:
-        child_name = child.get('name')
         counts['total_ct'] += 1
-        if dutils.item_is_folder(child):
-            new_parents = [*parents, child]
-            counts['folder_ct'] += 1
-            list_files_recursively(user, service, child, new_parents, counts, details=details)
-        else:
-            pars = [p['name'] for p in parents]
-            details_text = dutils.get_details_text(details, child, user)
-            # print(f"{' > '.join([*pars, child_name])}{details_text}")
-            logging.info(f"{' > '.join([*pars, child_name])}{details_text}")
+        if not dutils.item_is_folder(child):
+            logging.info(get_item_line(user, child, [folder], details=details))
+            if snapshot is not None:
+                dchanges.add_snapshot_item(snapshot, child, [folder])
+            if progress:
+                progress.add_processed()
+            continue
+        counts['folder_ct'] += 1
+        lines, shard_counts, shard_snapshot, error = next(shards)
+        dshard.add_shard_result(child, lines, shard_counts, error, counts)
+        if snapshot is not None and shard_snapshot:
+            snapshot.update(shard_snapshot)
+        if progress:
+            progress.add_discovered(shard_counts.get('total_ct', 0))
+            progress.add_processed(shard_counts.get('total_ct', 0) + 1)
     return counts
 
-def run_list_files(user, service, folder, details=False):
+def run_list_files(user, service, folder, details=False, processes=1, state_file=None):
     # Process folder.
     folder_id = folder.get('id', None)
     # dutils.eprint(f"Listing all files recursively for \"{folder.get('name')}\"...")
     parents = [folder]
     counts = {'total_ct': 1, 'folder_ct': 1}
-    counts = list_files_recursively(user, service, folder, parents, counts, details=details)
+    total = None
+    if state_file:
+        # Pre-count items from the last saved listing of this folder.
+        total = dchanges.get_item_count(Path(state_file).parent, folder_id)
+    progress = dprogress.Progress(total=total)
+    dprogress.track_requests(service, progress)
+    state = None
+    snapshot = None
+    if state_file:
+        # Get the changes token first so that changes made during the listing
+        # are included next time.
+        state = dchanges.start_state(service, folder)
+    if state:
+        snapshot = state['items']
+    if processes > 1:
+        counts = list_files_sharded(user, service, folder, counts, details=details, processes=processes, progress=progress, snapshot=snapshot)
+    else:
+        counts = list_files_recursively(user, service, folder, parents, counts, details=details, progress=progress, snapshot=snapshot)
+    progress.finish()
+    if counts.get('error_ct'):
+        # A partial snapshot would show the missing items as added next time.
+        logging.warning(f"{counts['error_ct']} subfolder(s) not fully listed; listing state not saved.")
+    elif state:
+        dchanges.save_state(state, state_file)
     # Print summary.
     folder_ct = counts['folder_ct']
     file_ct = counts['total_ct'] - folder_ct
@@ -69,4 +155,151 @@ def run_list_files(user, service, folder, details=False):
     d = '' if folder_ct == 1 else 's'
     f = '' if file_ct == 1 else 's'
     dutils.eprint(f"\nTotal: {folder_ct} folder{d} and {file_ct} file{f}.")
+    if counts.get('error_ct'):
+        dutils.eprint(f"{counts['error_ct']} subfolder(s) not fully listed because of errors; see log.")
     # logging.warning(f"\nTotal: {folder_ct} folder{d} and {file_ct} file{f}.")
+    return counts
+
+def get_usage_recursively(service, folder, top=20, progress=None):
+    """
+    Get total bytes, files and folders of "folder" and of its "top" largest
+    subtrees, rolling totals up the tree as each folder is finished.
+    """
+    fields = 'nextPageToken, files(id, name, mimeType, driveId, quotaBytesUsed, size)'
+    # Running [bytes, files, folders] of each folder still being walked.
+    open_totals = {}
+    root_totals = []
+    # Heap of the largest finished subtrees: (bytes, order, path, files, folders).
+    largest = []
+    finished = [0]
+
+    def add_item(item, parents):
+        if dutils.item_is_folder(item):
+            open_totals[item.get('id')] = [0, 0, 0]
+        elif parents:
+            totals = open_totals[parents[-1].get('id')]
+            totals[0] += int(item.get('quotaBytesUsed') or item.get('size') or 0)
+            totals[1] += 1
+
+    def finish_folder(item, parents):
+        if not dutils.item_is_folder(item):
+            return
+        totals = open_totals.pop(item.get('id'))
+        if parents:
+            parent_totals = open_totals[parents[-1].get('id')]
+            parent_totals[0] += totals[0]
+            parent_totals[1] += totals[1]
+            parent_totals[2] += totals[2] + 1
+        path = ' > '.join([*[p['name'] for p in parents], item.get('name')])
+        finished[0] += 1
+        entry = (totals[0], finished[0], path, totals[1], totals[2])
+        if len(largest) < top:
+            heapq.heappush(largest, entry)
+        else:
+            heapq.heappushpop(largest, entry)
+        if not parents:
+            root_totals.extend(totals)
+
+    dwalk.walk_tree(
+        folder,
+        lambda item: get_folder_children(service, item, fields=fields),
+        pre_visit=add_item,
+        post_visit=finish_folder,
+        progress=progress,
+        get_children_many=lambda items: dutils.get_children_many(service, items, fields=fields),
+    )
+    return root_totals, sorted(largest, reverse=True)
+
+def run_folder_usage(user, service, folder, top=20):
+    progress = dprogress.Progress()
+    dprogress.track_requests(service, progress)
+    totals, largest = get_usage_recursively(service, folder, top=top, progress=progress)
+    progress.finish()
+    logging.info(f"Largest {len(largest)} folders in \"{folder.get('name')}\":")
+    for size, i, path, file_ct, folder_ct in largest:
+        logging.info(f"{dutils.format_size(size):>10}  {file_ct:>7} files  {folder_ct:>6} folders  {path}")
+    # Print summary.
+    size, file_ct, folder_ct = totals
+    # Ensure proper plurals; the top folder counts as a folder.
+    folder_ct += 1
+    d = '' if folder_ct == 1 else 's'
+    f = '' if file_ct == 1 else 's'
+    dutils.eprint(f"\nTotal: {dutils.format_size(size)} in {folder_ct} folder{d} and {file_ct} file{f}.")
+    return {'bytes': size, 'total_ct': folder_ct + file_ct, 'folder_ct': folder_ct}
+
+def get_duplicates_recursively(service, folder, progress=None):
+    """
+    Get groups of files with the same size and md5Checksum under "folder" as a
+    dict of (size, md5Checksum): list of paths. Files are indexed by size
+    first; only sizes seen more than once are indexed by checksum.
+
+    Memory isn't bounded by the number of duplicates: it grows with the number
+    of distinct sizes plus the files whose size repeats, i.e. up to one small
+    entry per file, and folder path strings stay alive while any of their
+    files is indexed.
+    """
+    fields = 'nextPageToken, files(id, name, mimeType, driveId, size, md5Checksum)'
+    # Path of each folder still being walked; files share their folder's string,
+    # which outlives the folder's walk if any of its files is indexed below.
+    folder_paths = {}
+    # First file seen of each size as (md5Checksum, folder path, name); None
+    # once it has been moved to "by_checksum".
+    first_by_size = {}
+    # Files of sizes seen more than once, by (size, md5Checksum).
+    by_checksum = {}
+
+    def add_item(item, parents):
+        parent_path = folder_paths.get(parents[-1].get('id')) if parents else None
+        if dutils.item_is_folder(item):
+            name = item.get('name')
+            folder_paths[item.get('id')] = f"{parent_path} > {name}" if parent_path else name
+            return
+        md5 = item.get('md5Checksum')
+        size = int(item.get('size') or 0)
+        if not md5 or not size:
+            # Google Docs, shortcuts and empty files.
+            return
+        entry = (parent_path, item.get('name'))
+        if size not in first_by_size:
+            first_by_size[size] = (md5, *entry)
+            return
+        first = first_by_size[size]
+        if first is not None:
+            by_checksum.setdefault((size, first[0]), []).append(first[1:])
+            first_by_size[size] = None
+        by_checksum.setdefault((size, md5), []).append(entry)
+
+    def finish_folder(item, parents):
+        folder_paths.pop(item.get('id'), None)
+
+    dwalk.walk_tree(
+        folder,
+        lambda item: get_folder_children(service, item, fields=fields),
+        pre_visit=add_item,
+        post_visit=finish_folder,
+        progress=progress,
+        get_children_many=lambda items: dutils.get_children_many(service, items, fields=fields),
+    )
+    return {
+        key: [f"{parent_path} > {name}" for parent_path, name in entries]
+        for key, entries in by_checksum.items()
+        if len(entries) > 1
+    }
+
+def run_find_duplicates(user, service, folder):
+    progress = dprogress.Progress()
+    dprogress.track_requests(service, progress)
+    duplicates = get_duplicates_recursively(service, folder, progress=progress)
+    progress.finish()
+    # Show groups that waste the most space first.
+    groups = sorted(duplicates.items(), key=lambda d: d[0][0] * (len(d[1]) - 1), reverse=True)
+    wasted = 0
+    for (size, md5), paths in groups:
+        wasted += size * (len(paths) - 1)
+        logging.info(f"{len(paths)} copies of {dutils.format_size(size)} ({md5}):")
+        for path in paths:
+            logging.info(f"   {path}")
+    # Print summary.
+    g = '' if len(groups) == 1 else 's'
+    dutils.eprint(f"\nTotal: {len(groups)} group{g} of duplicates, {dutils.format_size(wasted)} in extra copies.")
+    return {'group_ct': len(groups), 'bytes': wasted}
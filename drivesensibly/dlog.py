@@ -22,6 +22,13 @@ class SingleLevel(object):
     def filter(self, logRecord):
         return logRecord.levelno == self.level
 
+class ThreadOnly(object):
+    def __init__(self, thread_name):
+        self.thread_name = thread_name
+
+    def filter(self, logRecord):
+        return logRecord.threadName == self.thread_name
+
 def setup_logging(loglevel):
     levels = {
         'DEBUG': logging.DEBUG,
@@ -77,3 +84,5 @@ def setup_logging(loglevel):
 
     # Silence silly "file_cache" WARNING:
     logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+
+    return log_path
@@ -1,123 +1,236 @@
-import googleapiclient.errors
 import logging
 
+import dbackend
+import dlist
+import dprogress
 import dutils
+import dwalk
 
-from dlist import list_parents_recursively
-
+FOLDER_MIMETYPE = dbackend.FOLDER_MIMETYPE
+# Most ids that files.generateIds returns per call.
+MAX_GENERATED_IDS = 1000
 
 def show_result(service, result, item):
     if result:
         parents_string = dutils.get_parents_string(service, result)
         x = '\u2713'
-        print(f"{x} {parents_string} > {result.get('name')}")
+        logging.info(f"{x} {parents_string} > {result.get('name')}")
     else:
         x = '\u2717'
-        print(f"{x} {item.get('name')}")
-
-def remove_drive_item(service, item, type='delete'):
-    result = False
-    if dutils.item_is_folder(item):
-        children = dutils.get_children(service, item.get('id'))
-        if children:
-            print(f"Error: Folder \"{item.get('name')}\" is not empty. Skipping removal.")
-            return result
-    try:
-        if type == 'delete':
-            # Delete file.
-            try:
-                response = service.files().delete(
-                    fileId=item.get('id'),
-                ).execute()
-            except Exception as e:
-                print(f"Error: {e}")
-            if not response:
-                result = True
-        elif type == 'trash':
-            # Move file to the trash.
-            body = {"trashed": True}
-            try:
-                response = service.files().update(
-                    fileId=item.get('id'),
-                    body=body,
-                ).execute()
-            except Exception as e:
-                print(f"Error: {e}")
-            if response.get('id'):
-                result = True
-    except Exception as e:
-        print(f"Error: {e}")
-        exit(1)
-    return result
-
-def create_folder_in_shared_drive(service, item, metadata):
-    # Re-create the folder under the destination.
-    #   Returns new-item id dict.
-    try:
-        result = service.files().create(
-            body=metadata,
-            supportsAllDrives=True,
-            fields='id',
-        ).execute()
-    except Exception as e:
-        print(f"Error: {e}")
-        exit(1)
-    return result
+        logging.info(f"{x} {item.get('name')}")
 
 def move_item_to_shared_drive(service, item, new_parents):
-    # Move the file into the destination.
+    # Move the file into the destination; returns None if it failed, so that
+    # the rest of the tree is still moved and its source folder is kept.
     try:
-        result = service.files().update(
-            fileId=item['id'],
-            addParents=new_parents,
-            supportsAllDrives=True,
-            removeParents=f"{','.join(item.get('parents'))}"
-        ).execute()
+        result = dbackend.get_backend(service).move_item(
+            item['id'],
+            new_parents,
+            f"{','.join(item.get('parents'))}",
+        )
     except Exception as e:
-        print(f"Error: {e}")
-        exit(1)
+        logging.error(e)
+        return None
     return result
 
-def move_items_recursively(service, item, destination, dest_drive):
+def generate_ids(service, count):
+    """Get "count" new item ids from Drive, so that items can be created by id."""
+    ids = []
+    while len(ids) < count:
+        try:
+            new_ids = dbackend.get_backend(service).generate_ids(min(count - len(ids), MAX_GENERATED_IDS))
+        except Exception as e:
+            logging.error(e)
+            exit(1)
+        ids.extend(new_ids)
+    return ids
+
+def create_folders_batch(service, folders):
+    """
+    Create folders from a list of (new_id, name, parent_id) with batch
+    requests; returns the set of new_ids that were created.
+    """
+    created = set()
+    for new_id, exception in dbackend.get_backend(service).create_folders(folders).items():
+        if exception:
+            logging.error(exception)
+        else:
+            created.add(new_id)
+    return created
+
+def trash_items_batch(service, items):
+    """Move items to the trash with batch requests; returns the set of trashed ids."""
+    item_ids = [item.get('id') for item in items]
+    trashed = set()
+    for item_id, exception in dbackend.get_backend(service).trash_items(item_ids).items():
+        if exception:
+            logging.error(exception)
+        else:
+            trashed.add(item_id)
+    return trashed
+
+def move_items_recursively(service, item, destination, dest_drive, progress=None, signatures=None):
+    """
+    Move "item" and everything under it to "destination"; if "signatures" is
+    a dict, the source tree's signatures (see dlist.get_tree_signatures) are
+    added to it from the same listing.
+    """
     if not dutils.item_is_folder(item):
         # Move file.
-        new_parent = destination.get('id')
-        new_item_id = move_item_to_shared_drive(service, item, new_parent)
-        if new_item_id:
-            new_item = dutils.get_drive_item(service, new_item_id.get('id'))
-        # Can't just use the returned item from "move" b/c it's lacking parent info.
+        result = move_item_to_shared_drive(service, item, destination.get('id'))
+        new_item = dutils.get_drive_item(service, result.get('id')) if result else None
         show_result(service, new_item, item)
-    else:
-        # Move folder and children.
-        #   Check to see if folder exists in destination.
-        #       List destination's children by name.
-        dest_children = dutils.get_children(service, destination.get('id'), shared_drive=dest_drive)
-        new_parent = None
-        for dest_child in dest_children:
-            if dest_child.get('name') == item.get('name'):
-                new_parent = dest_child
-                break
-        if not new_parent:
-            # Set the new folder's metadata.
-            metadata = {
-                'name': item.get('name', 'unnamed'),
-                'parents': [destination.get('id')],
-                'mimeType': 'application/vnd.google-apps.folder',
-            }
-            # Re-create the folder under the destination.
-            new_id = create_folder_in_shared_drive(service, item, metadata)
-            if new_id:
-                new_parent = dutils.get_drive_item(service, new_id.get('id'))
-            show_result(service, new_parent, item)
-
-        # Move children to new folder.
-        children = dutils.get_children(service, item['id'])
-        for child in children:
-            move_items_recursively(service, child, new_parent, dest_drive)
-        # Remove empty folder.
-        remove_drive_item(service, item)
-
-def run_move_folder(user, service, folder, destination_string):
+        return None
+
+    # List the source tree once: folders by depth, files by source folder id.
+    fields = 'nextPageToken, files(id, name, mimeType, parents, size, md5Checksum)'
+    levels = []
+    files = {}
+    subfolders = {}
+
+    def get_folder_children(folder):
+        children = dutils.get_children(service, folder['id'], fields=fields)
+        if progress:
+            progress.add_discovered(len(children))
+        return children
+
+    def get_folders_children(folders):
+        children = dutils.get_children_many(service, folders, fields=fields)
+        if progress:
+            progress.add_discovered(sum(len(c) for c in children))
+        return children
+
+    def add_item(src_item, src_parents):
+        if signatures is not None:
+            dlist.add_signature(signatures, src_item, src_parents)
+        parent_id = src_parents[-1]['id'] if src_parents else None
+        if dutils.item_is_folder(src_item):
+            while len(levels) <= len(src_parents):
+                levels.append([])
+            levels[len(src_parents)].append((src_item, parent_id))
+            subfolders.setdefault(parent_id, []).append(src_item)
+        else:
+            files.setdefault(parent_id, []).append(src_item)
+
+    if progress:
+        progress.add_discovered()
+    dwalk.walk_tree(item, get_folder_children, pre_visit=add_item, get_children_many=get_folders_children)
+    if signatures is not None:
+        dlist.sort_signatures(signatures)
+
+    # Create the folder skeleton one level at a time, parents before children,
+    # with ids generated up front; existing same-named folders are reused.
+    new_ids = generate_ids(service, sum(len(level) for level in levels))
+    # Destination folder and path of each source folder, by source id.
+    dest_folders = {}
+    dest_paths = {None: dutils.get_item_path(service, destination)}
+    # Destination folders that existed before the move and may have children.
+    existing_ids = {destination.get('id')}
+    for level in levels:
+        existing = {}
+        parent_dest_ids = set()
+        for src_folder, src_parent_id in level:
+            parent_dest = dest_folders.get(src_parent_id) if src_parent_id else destination
+            if parent_dest and parent_dest.get('id') in existing_ids:
+                parent_dest_ids.add(parent_dest.get('id'))
+        for parent_dest_id in parent_dest_ids:
+            for dest_child in dutils.get_children(service, parent_dest_id, shared_drive=dest_drive):
+                if dutils.item_is_folder(dest_child):
+                    existing.setdefault((parent_dest_id, dest_child.get('name')), dest_child)
+
+        to_create = []
+        for src_folder, src_parent_id in level:
+            parent_dest = dest_folders.get(src_parent_id) if src_parent_id else destination
+            if not parent_dest:
+                # Parent wasn't created; leave the folder and its children in place.
+                continue
+            name = src_folder.get('name', 'unnamed')
+            dest_paths[src_folder['id']] = f"{dest_paths[src_parent_id]} > {name}"
+            match = existing.get((parent_dest.get('id'), name))
+            if match:
+                dest_folders[src_folder['id']] = match
+                existing_ids.add(match.get('id'))
+            else:
+                to_create.append((src_folder, new_ids.pop(), parent_dest.get('id')))
+
+        created = create_folders_batch(service, [(i, f.get('name', 'unnamed'), p) for f, i, p in to_create])
+        for src_folder, new_id, parent_dest_id in to_create:
+            if new_id in created:
+                dest_folders[src_folder['id']] = {
+                    'id': new_id,
+                    'name': src_folder.get('name', 'unnamed'),
+                    'mimeType': FOLDER_MIMETYPE,
+                    'driveId': dest_drive.get('id'),
+                }
+                logging.info(f"\u2713 {dest_paths[src_folder['id']]}")
+            else:
+                logging.info(f"\u2717 {src_folder.get('name')}")
+            if progress:
+                progress.add_processed()
+        if progress:
+            progress.add_processed(len(level) - len(to_create))
+
+    # Move files into their new folders.
+    failed_ids = set()
+    for src_parent_id, src_files in files.items():
+        dest_folder = dest_folders.get(src_parent_id)
+        for src_file in src_files:
+            result = None
+            if dest_folder:
+                result = move_item_to_shared_drive(service, src_file, dest_folder.get('id'))
+            if result:
+                logging.info(f"\u2713 {dest_paths[src_parent_id]} > {src_file.get('name')}")
+            else:
+                logging.info(f"\u2717 {src_file.get('name')}")
+                failed_ids.add(src_parent_id)
+            if progress:
+                progress.add_processed()
+
+    # Trash emptied source folders in batches, deepest level first; a folder
+    # is empty once all of its files were moved and its subfolders trashed.
+    # Trashing rather than deleting keeps anything added since the listing.
+    trashed_ids = set()
+    for level in reversed(levels):
+        empty_folders = []
+        for src_folder, src_parent_id in level:
+            if src_folder['id'] not in dest_folders or src_folder['id'] in failed_ids:
+                continue
+            if all(f['id'] in trashed_ids for f in subfolders.get(src_folder['id'], [])):
+                empty_folders.append(src_folder)
+        trashed_ids.update(trash_items_batch(service, empty_folders))
+        for src_folder in empty_folders:
+            if src_folder['id'] not in trashed_ids:
+                logging.error(f"Folder \"{src_folder.get('name')}\" could not be removed.")
+
+    # Return the new top folder, if any.
+    return dest_folders.get(item['id'])
+
+def compare_trees(source, destination):
+    """Compare two get_tree_signatures results; returns missing, extra and mismatched paths."""
+    source_paths = set(source)
+    dest_paths = set(destination)
+    missing = sorted(source_paths - dest_paths)
+    extra = sorted(dest_paths - source_paths)
+    mismatched = sorted(p for p in source_paths & dest_paths if source[p] != destination[p])
+    return missing, extra, mismatched
+
+def verify_move(service, source_signatures, dest_folder):
+    logging.info(f"Verifying \"{dest_folder.get('name')}\" ({dest_folder.get('id')})...")
+    dest_signatures = dlist.get_tree_signatures(service, dest_folder)
+    missing, extra, mismatched = compare_trees(source_signatures, dest_signatures)
+    for path in missing:
+        logging.error(f"Missing: {path}")
+    for path in extra:
+        logging.warning(f"Extra: {path}")
+    for path in mismatched:
+        logging.error(f"Mismatched: {path}")
+    logging.info(
+        f"Verification: {len(source_signatures)} paths checked, {len(missing)} missing, "
+        f"{len(extra)} extra, {len(mismatched)} mismatched."
+    )
+    return not missing and not mismatched
+
+def run_move_folder(user, service, folder, destination_string, verify=False):
     # Ensure valid destination drive and folder.
     path_parts = destination_string.split('>')
     dest_drive_string = destination_string.split('>')[0].strip()
@@ -144,8 +257,19 @@ def run_move_folder(user, service, folder, destination_string):
         logging.error(error)
         return 1
 
-    print(f"Moving \"{folder['name']}\" recursively to \"{parent_folder.get('name')}\" ({parent_folder.get('id')})...")
-    move_items_recursively(service, folder, parent_folder, dest_drive)
+    logging.info(f"Moving \"{folder['name']}\" recursively to \"{parent_folder.get('name')}\" ({parent_folder.get('id')})...")
+    # Source items are moved away, so get their signatures from the move's listing.
+    source_signatures = {} if verify else None
+    progress = dprogress.Progress()
+    dprogress.track_requests(service, progress)
+    dest_folder = move_items_recursively(service, folder, parent_folder, dest_drive, progress=progress, signatures=source_signatures)
+    progress.finish()
+    if verify:
+        if not dest_folder:
+            logging.error(f"Error: Can't verify; \"{folder['name']}\" not found in destination.")
+            return 1
+        if not verify_move(service, source_signatures, dest_folder):
+            return 1
 
 def run_move_filelist(user, service, input_file, destination_string):
     # Validate destination drive.
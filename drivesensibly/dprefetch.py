@@ -0,0 +1,70 @@
+import logging
+import threading
+
+import djobs
+import dshard
+import dutils
+
+
+class Prefetcher(object):
+    """
+    Warm the shared-drive list and a folder-name index in a background
+    thread while the operator answers prompts.
+    """
+    def __init__(self, service):
+        self.service = service
+        # Folders by name, from all drives.
+        self.folder_index = None
+
+    def start(self):
+        self.run_in_thread(self.warm_shared_drives, self.warm_folder_index)
+
+    def run_in_thread(self, *funcs):
+        # Daemon threads don't hold up exit if prefetching is still running.
+        def run():
+            for func in funcs:
+                func()
+        threading.Thread(target=run, name='prefetch', daemon=True).start()
+
+    def warm_shared_drives(self):
+        try:
+            dutils.get_shared_drive_list(self.service, '')
+        except (Exception, SystemExit) as e:
+            logging.debug(f"Prefetch of shared drives failed: {e!r}")
+
+    def warm_folder_index(self):
+        q = "mimeType = 'application/vnd.google-apps.folder' and not trashed"
+        try:
+            folders = dutils.get_all_drive_search_results(self.service, q)
+        except (Exception, SystemExit) as e:
+            logging.debug(f"Prefetch of folder index failed: {e!r}")
+            return
+        index = {}
+        for folder in folders:
+            index.setdefault(folder.get('name'), []).append(folder)
+        self.folder_index = index
+        logging.debug(f"Prefetched {len(folders)} folder names.")
+
+    def find_folders(self, name_string, shared_drive=None, all_drives=False):
+        """Get folders named "name_string" from the index, or None if not ready."""
+        if self.folder_index is None:
+            return None
+        results = self.folder_index.get(name_string, [])
+        if shared_drive:
+            return [r for r in results if r.get('driveId') == shared_drive.get('id')]
+        elif all_drives:
+            return list(results)
+        # Same scope as a 'user' corpus search.
+        return [r for r in results if not r.get('driveId')]
+
+
+def start_prefetch(service):
+    """Start prefetching with a thread-safe copy of "service"; returns the Prefetcher."""
+    credentials = dshard.get_credentials(service)
+    if credentials is None:
+        logging.debug("No credentials available for prefetch.")
+        return None
+    prefetcher = Prefetcher(djobs.build_service(credentials))
+    dutils.prefetcher = prefetcher
+    prefetcher.start()
+    return prefetcher
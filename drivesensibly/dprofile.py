@@ -0,0 +1,150 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from urllib.parse import urlparse
+
+
+# Path segments that name an API method rather than an item id.
+API_METHODS = ['about', 'batch', 'changes', 'drive', 'drives', 'files', 'generateIds',
+    'permissions', 'startPageToken', 'upload', 'v3', 'watch']
+
+
+def get_endpoint(method, uri):
+    """Get e.g. "GET /drive/v3/files/{id}" from a request's method and uri."""
+    segments = []
+    for segment in urlparse(uri).path.split('/'):
+        if segment and segment not in API_METHODS:
+            segment = '{id}'
+        segments.append(segment)
+    return f"{method} {'/'.join(segments)}"
+
+
+class Profiler(object):
+    """
+    Capture a cProfile dump and a Chrome trace-event timeline of every API
+    request; both are saved next to the run's log file. The dump covers the
+    main thread and threads started after profiling began (job threads, the
+    prefetcher); earlier ones, like the async client's event loop, aren't in it.
+    """
+    def __init__(self, log_path):
+        self.profile_path = log_path.with_suffix('.prof')
+        self.trace_path = log_path.with_suffix('.trace.json')
+        self.profile = cProfile.Profile()
+        # Profiles of the threads started since profiling began.
+        self.thread_profiles = []
+        self.events = []
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.start_cpu_time = None
+
+    def start(self, service):
+        self.track_requests(service)
+        self.start_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+        # cProfile only profiles the thread that enables it.
+        threading.setprofile(self.profile_thread)
+        self.profile.enable()
+
+    def profile_thread(self, frame, event, arg):
+        # Called first thing in each new thread; hand over to a cProfile.
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.thread_profiles.append(profile)
+        profile.enable()
+
+    def track_requests(self, service):
+        """
+        Time the requests made by "service": its own HTTP object, each thread's
+        HTTP object for thread-safe services, or the async client's connection
+        pool. Returns False if there's nothing to time.
+        """
+        client = getattr(service, 'client', None)
+        if client is not None and hasattr(client, 'pool'):
+            self.track_pool(client.pool)
+            return True
+        http = getattr(service, '_http', None)
+        if http is None:
+            # Service doesn't make HTTP requests (e.g. MemoryBackend).
+            logging.warning("Profile: this service makes no HTTP requests to time.")
+            return False
+        self.track_http(http)
+        hooks = getattr(service, 'ds_http_hooks', None)
+        if hooks is not None:
+            # Thread-safe service; other threads get their own HTTP objects.
+            hooks.append(self.track_http)
+        return True
+
+    def track_http(self, http):
+        http_request = http.request
+
+        def request(uri, method='GET', *args, **kwargs):
+            start = time.perf_counter()
+            response = None
+            try:
+                response = http_request(uri, method, *args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                status = response[0].status if response else None
+                self.add_request(method, uri, start, end, status)
+            return response
+
+        http.request = request
+
+    def track_pool(self, pool):
+        pool_request = pool.request
+
+        async def request(method, target, *args, **kwargs):
+            start = time.perf_counter()
+            response = None
+            try:
+                response = await pool_request(method, target, *args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                status = response[0] if response else None
+                self.add_request(method, target, start, end, status)
+            return response
+
+        pool.request = request
+
+    def add_request(self, method, uri, start, end, status):
+        event = {
+            'name': get_endpoint(method, uri),
+            'cat': 'api',
+            'ph': 'X',
+            'ts': round((start - self.start_time) * 1e6),
+            'dur': round((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {'status': status, 'thread': threading.current_thread().name},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def stop(self):
+        self.profile.disable()
+        threading.setprofile(None)
+        wall_time = time.perf_counter() - self.start_time
+        cpu_time = time.process_time() - self.start_cpu_time
+        request_time = sum(e['dur'] for e in self.events) / 1e6
+
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            for profile in self.thread_profiles:
+                stats.add(profile)
+        stats.dump_stats(self.profile_path)
+        with open(self.trace_path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+        logging.info(
+            f"Profile: {wall_time:.1f}s wall, {cpu_time:.1f}s CPU, "
+            f"{request_time:.1f}s in {len(self.events)} API requests, "
+            f"{len(self.thread_profiles) + 1} threads profiled."
+        )
+        logging.info(f"Profile saved to \"{self.profile_path}\" and \"{self.trace_path}\".")
@@ -0,0 +1,144 @@
+import json
+import logging
+import sys
+import time
+
+
+class Progress(object):
+    """
+    Track items discovered and processed, API requests and error responses,
+    and report them periodically: in place on a TTY, as JSON records otherwise.
+    """
+    # Set to False to disable reporting, e.g. when several runs share stderr.
+    enabled = True
+    # Stream showing a progress line that log records must clear first.
+    line_stream = None
+
+    def __init__(self, total=None, interval=None, stream=None):
+        self.stream = stream if stream else sys.stderr
+        self.tty = self.stream.isatty()
+        if interval is None:
+            interval = 0.5 if self.tty else 10
+        self.interval = interval
+        # Pre-counted number of items (e.g. from a snapshot), if known.
+        self.total = total
+        self.discovered = 0
+        self.processed = 0
+        self.requests = 0
+        self.errors = 0
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+        if self.tty and self.enabled:
+            clear_line_before_logs()
+
+    def add_discovered(self, n=1):
+        self.discovered += n
+        self.update()
+
+    def add_processed(self, n=1):
+        self.processed += n
+        self.update()
+
+    def add_request(self, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.update()
+
+    def get_stats(self):
+        elapsed = time.monotonic() - self.start_time
+        items_rate = self.processed / elapsed if elapsed else 0.0
+        requests_rate = self.requests / elapsed if elapsed else 0.0
+        # The tree may have grown since it was pre-counted.
+        total = max(self.total or 0, self.discovered)
+        eta = None
+        if items_rate and total >= self.processed:
+            eta = (total - self.processed) / items_rate
+        return {
+            'elapsed': round(elapsed, 1),
+            'discovered': self.discovered,
+            'processed': self.processed,
+            'total': total if self.total else None,
+            'items_per_s': round(items_rate, 1),
+            'requests': self.requests,
+            'requests_per_s': round(requests_rate, 1),
+            'errors': self.errors,
+            'eta': round(eta, 1) if eta is not None else None,
+        }
+
+    def get_text(self, stats):
+        total = stats['total'] if stats['total'] else stats['discovered']
+        percent = f" ({100 * stats['processed'] / total:.0f}%)" if total else ''
+        eta = format_seconds(stats['eta']) if stats['eta'] is not None else '?'
+        return (
+            f"{stats['processed']}/{total}{percent} items, "
+            f"{stats['items_per_s']} items/s, {stats['requests_per_s']} req/s, "
+            f"{stats['errors']} errors, ETA {eta}"
+        )
+
+    def update(self, force=False):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        stats = self.get_stats()
+        if self.tty:
+            # Redraw the line in place; log records clear it first (see ClearLine).
+            self.stream.write(f"\r\x1b[K{self.get_text(stats)}")
+            Progress.line_stream = self.stream
+        else:
+            self.stream.write(f"{json.dumps({'progress': stats})}\n")
+        self.stream.flush()
+
+    def finish(self):
+        self.update(force=True)
+        if self.tty and self.enabled:
+            self.stream.write('\n')
+            self.stream.flush()
+            Progress.line_stream = None
+
+
+class ClearLine(object):
+    """Clear a shown progress line before a log record is written."""
+    def filter(self, logRecord):
+        stream = Progress.line_stream
+        if stream:
+            stream.write('\r\x1b[K')
+            stream.flush()
+            Progress.line_stream = None
+        return True
+
+def clear_line_before_logs():
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            continue
+        if not any(isinstance(f, ClearLine) for f in handler.filters):
+            handler.addFilter(ClearLine())
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+def track_requests(service, progress):
+    """Count the HTTP requests made by "service" in "progress"."""
+    http = getattr(service, '_http', None)
+    if http is None:
+        # Service is not backed by an httplib2 object (e.g. dasync).
+        return
+    if not hasattr(http, 'ds_progress'):
+        http_request = http.request
+
+        def request(*args, **kwargs):
+            response, content = http_request(*args, **kwargs)
+            # Throttled and server-error responses; these aren't retried.
+            error = response.status == 429 or response.status >= 500
+            if http.ds_progress:
+                http.ds_progress.add_request(error=error)
+            return response, content
+
+        http.request = request
+    http.ds_progress = progress
@@ -0,0 +1,61 @@
+import logging
+import multiprocessing
+
+
+# Drive service of the current worker process.
+worker_service = None
+
+
+def get_credentials(service):
+    http = getattr(service, '_http', None)
+    return getattr(http, 'credentials', None)
+
+def init_worker(credentials):
+    global worker_service
+    from googleapiclient.discovery import build
+    worker_service = build('drive', 'v3', credentials=credentials)
+
+def run_shard(args):
+    """
+    Run func(shard_args, output, counts) in a worker; returns (lines output,
+    counts, func's result, error), with what was done before any error.
+    """
+    func, shard_args = args
+    lines = []
+    counts = {}
+    result = None
+    error = None
+    try:
+        result = func(shard_args, lines.append, counts)
+    except (Exception, SystemExit) as e:
+        # An uncaught exit would kill the worker and leave the pool waiting.
+        error = repr(e)
+    return lines, counts, result, error
+
+def imap_shards(service, func, shard_args, processes):
+    """
+    Run func(args, output, counts) for each of "shard_args" in worker
+    processes, each with its own Drive service; run_shard results are yielded
+    in the order of "shard_args".
+    """
+    global worker_service
+    args = [(func, a) for a in shard_args]
+    credentials = get_credentials(service)
+    if processes < 2 or credentials is None:
+        if processes > 1:
+            logging.warning("No credentials available for worker processes; using one process.")
+        worker_service = service
+        yield from map(run_shard, args)
+        return
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(credentials,)) as pool:
+        yield from pool.imap(run_shard, args)
+
+def add_shard_result(folder, lines, shard_counts, error, counts):
+    """Log a shard's lines and any error, and add its counts to "counts"."""
+    for line in lines:
+        logging.info(line)
+    if error:
+        logging.error(f"Error: \"{folder.get('name')}\" not fully handled: {error}")
+        counts['error_ct'] = counts.get('error_ct', 0) + 1
+    for key, count in shard_counts.items():
+        counts[key] = counts.get(key, 0) + count
@@ -1,7 +1,28 @@
 import logging
 import sys
+import threading
 
-from dlist import list_parents_recursively
+from dbackend import get_backend
+
+# Fields of search results; all useful fields at one time to minimize network traffic.
+USER_DRIVE_FIELDS = '\
+    nextPageToken, files(id, name, mimeType, modifiedTime, ownedByMe, \
+    sharedWithMeTime, owners, parents, permissions)\
+'
+SHARED_DRIVE_FIELDS = '\
+    nextPageToken, files(id, name, driveId, mimeType, modifiedTime, ownedByMe, \
+    sharedWithMeTime, owners, parents, permissions, capabilities)\
+'
+
+# Folders fetched as ancestors of other items, by id; shared by all lookups.
+ancestor_cache = {}
+
+# Background Prefetcher (see dprefetch), if one is running.
+prefetcher = None
+
+# Shared drives of the authenticated user, fetched once per run.
+shared_drive_list = None
+shared_drive_list_lock = threading.Lock()
 
 
 def eprint(*args, **kwargs):
@@ -15,6 +36,14 @@ def get_details_text(details, item, user):
             details_text = f"\t({owner_email})"
     return details_text
 
+def format_size(num_bytes):
+    size = float(num_bytes)
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024 or unit == 'TB':
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+
 def item_is_folder(item):
     if item.get('mimeType', None) == 'application/vnd.google-apps.folder':
         return True
@@ -34,6 +63,27 @@ def item_is_shortcut(item):
 #             break
 #     return exists
 
+def list_parents_recursively(service, item, parents=None):
+    if parents is None:
+        parents = []
+    parents1_ids = item.get('parents', [])
+    if len(parents1_ids) > 0:
+        parents1 = []
+        for p_id in parents1_ids:
+            try:
+                p = get_backend(service).get_item(p_id, fields='id, name, mimeType, parents')
+            except Exception as e:
+                logging.error(e)
+                exit(1)
+            parents1.append(p)
+        # [-- Assuming 1st list item for now.
+        # parents1.sort() # can't sort list of dictionaries
+        parent = parents1[0]
+        # --]
+        parents.append(parent)
+        list_parents_recursively(service, parent, parents)
+    return parents
+
 def get_parents_string(service, item):
     parents = list_parents_recursively(service, item, [])
     tree = [p['name'] for p in parents]
@@ -41,8 +91,52 @@ def get_parents_string(service, item):
     parents_path_string = ' > '.join(tree)
     return parents_path_string
 
+def get_ancestors(service, item_ids):
+    """
+    Get ancestor items by id, from the shared ancestor cache or with batch
+    requests for those not cached yet; returns dict of id: item.
+    """
+    item_ids = set(item_ids)
+    # Sorted so that batches, and recordings of them, are the same each run.
+    new_ids = sorted(i for i in item_ids if i not in ancestor_cache)
+    if new_ids:
+        ancestor_cache.update(get_drive_items_batch(service, new_ids, fields='id, name, mimeType, parents'))
+    return {i: ancestor_cache[i] for i in item_ids if i in ancestor_cache}
+
+def get_parents_strings(service, items):
+    """
+    Get the parents string of each of the given items, resolving ancestors
+    one tree level at a time with a single batch request per level.
+    """
+    # Ancestor chain of each item, nearest parent first.
+    chains = [[] for i in items]
+    current = list(items)
+    while True:
+        next_ids = set()
+        for item in current:
+            if item and item.get('parents'):
+                next_ids.add(item.get('parents')[0])
+        if not next_ids:
+            break
+        ancestors = get_ancestors(service, next_ids)
+        for i, item in enumerate(current):
+            parent = None
+            if item and item.get('parents'):
+                parent = ancestors.get(item.get('parents')[0])
+            if parent:
+                chains[i].append(parent)
+            current[i] = parent
+    parents_strings = []
+    for chain in chains:
+        tree = [p['name'] for p in chain]
+        tree.reverse()
+        parents_strings.append(' > '.join(tree))
+    return parents_strings
+
 def get_item_path(service, item):
     parents_path = get_parents_string(service, item)
+    if not parents_path:
+        return item.get('name')
     item_path = f"{parents_path} > {item.get('name')}"
     return item_path
 
@@ -61,68 +155,43 @@ def get_item_from_path(service, path_names, path_items=None):
             # Keep this path.
             new_new_path = add_parent_to_path(service, path)
 
-def expand_path_names_to_items(service, path_names, path_items=None):
+def expand_path_names_to_items(service, path_names):
     """
     Convert path given as string to list of items.
     """
-    # Setup variables.
-    if path_items is None:
-        path_items = []
-    path_items_names = [i.get('name') for i in path_items]
     logging.debug(f"path_names: {path_names}")
-    logging.debug(f"path_items_names: {path_items_names}")
-    # Handle base case.
-    if path_items_names == path_names:
-        details = [f"{i.get('name')} ({i.get('id')})" for i in path_items]
-        logging.debug(f"Names: {' > '.join(path_names)}")
-        logging.debug(f"Expansion: {' > '.join(details)}")
-        return path_items
-    else:
-        # Handle recursive case: Get next path_item.
-        if len(path_items) == 0:
-            # Find first path_item.
-            next_i_in_names = len(path_names) - 1
-            logging.debug(f"next_i_in_names: {next_i_in_names}")
-            next_name = path_names[next_i_in_names]
-            logging.debug(f"next_name: {next_name}")
-            next_potential_items = search_drive_item_name(service, name_string=next_name, type='any')
-            logging.info(f"{len(next_potential_items)} matching items found for \"{next_name}\".")
-
-            # Determine which found items have the right parent folder name.
-            next_approved_items = []
-            for npi in next_potential_items:
-                # Get remaining names in path_items_names.
-                next_parents_names = path_names[:next_i_in_names]
-                logging.debug(f"next_parent_names: {next_parents_names}")
-
-                # Get parent_path_names to same depth as path_names.
-                npi_parents_items = list_parents_recursively(service, npi)[::-1]
-                npi_parents_names = [n.get('name') for n in npi_parents_items[-len(next_parents_names):]]
-                logging.debug(f"npi_parents_names: {npi_parents_names}")
-
-                # Add this next_item to next_approved_items if the lists match.
-                if npi_parents_names == next_parents_names:
-                    logging.info(f"Keeping \"{npi.get('name')}\" ({npi.get('id')})")
-                    next_approved_items.append(npi)
-
-            if len(next_approved_items) > 1:
-                nai_stats = [(i.get('name'), i.get('id')) for i in next_approved_items]
-                logging.debug(f"Too many possibilities: {nai_stats}")
-                return []
-            elif len(next_approved_items) == 1:
-                path_items.append(next_approved_items[0])
-                path_items = expand_path_names_to_items(service, path_names, path_items)
-                return path_items
-        else:
-            # Get parent of most recent path_item.
-            prev_item = path_items[0]
-            prev_item_parent_id = prev_item.get('parents')[0]
-            next_item = get_drive_item(service, prev_item_parent_id)
-            logging.debug(f"next_item.name|id: {next_item.get('name')}|{next_item.get('id')}")
-            # Append to path_items, continue search.
-            path_items.insert(0, next_item)
-            path_items = expand_path_names_to_items(service, path_names, path_items)
-            return path_items
+    leaf_name = path_names[-1]
+    candidates = search_drive_item_name(service, name_string=leaf_name, type='any')
+    logging.info(f"{len(candidates)} matching items found for \"{leaf_name}\".")
+
+    # Check all candidates' ancestors together, one level at a time, dropping
+    # candidates as soon as an ancestor's name doesn't match.
+    chains = [[c] for c in candidates]
+    for parent_name in reversed(path_names[:-1]):
+        parent_ids = [c[-1].get('parents')[0] for c in chains if c[-1].get('parents')]
+        parents = get_ancestors(service, parent_ids)
+        next_chains = []
+        for chain in chains:
+            parent = None
+            if chain[-1].get('parents'):
+                parent = parents.get(chain[-1].get('parents')[0])
+            if parent and parent.get('name') == parent_name:
+                next_chains.append([*chain, parent])
+        chains = next_chains
+        logging.debug(f"{len(chains)} candidates left after \"{parent_name}\".")
+        if not chains:
+            break
+
+    if len(chains) != 1:
+        stats = [(c[0].get('name'), c[0].get('id')) for c in chains]
+        logging.debug(f"No single possibility: {stats}")
+        return []
+    path_items = chains[0][::-1]
+    logging.info(f"Keeping \"{path_items[-1].get('name')}\" ({path_items[-1].get('id')})")
+    details = [f"{i.get('name')} ({i.get('id')})" for i in path_items]
+    logging.debug(f"Names: {' > '.join(path_names)}")
+    logging.debug(f"Expansion: {' > '.join(details)}")
+    return path_items
 
 def match_parents(service, parent_names, items):
     candidate_parents = []
@@ -142,11 +211,15 @@ def choose_item(service, results):
     if len(results) > 1:
         # eprint(f"{len(results)} results found. Please specify which item to handle:")
         logging.info(f"{len(results)} results found. Please specify which item to handle:")
+        parents_strings = get_parents_strings(service, results)
         for i, obj in enumerate(results):
-            parents_string = get_parents_string(service, obj)
+            parents_string = parents_strings[i]
             item_path = ' > '.join([parents_string, obj.get('name')])
             # eprint(f"   {i+1}. {item_path}")
             logging.info(f"   {i+1}. {item_path} ({obj.get('id')})")
+        if threading.current_thread() is not threading.main_thread():
+            # Jobs run in worker threads and can't prompt the operator.
+            raise ValueError(f"{len(results)} items named \"{results[0].get('name')}\" found; give a unique name.")
         eprint(f"\nEnter number:")
         # logging.info(f"\nEnter number:")
         obj_num = int(input().replace('.', '').strip())
@@ -166,31 +239,53 @@ def get_drive_item(service, item_id):
         sharedWithMeTime, owners, parents, permissions, capabilities \
     '
     try:
-        item = service.files().get(
-            fileId=item_id,
-            supportsAllDrives=True,
-            fields=fields,
-        ).execute()
+        item = get_backend(service).get_item(item_id, fields=fields)
     except Exception as e:
         # print(f"Error: {e}")
         logging.error(e)
     return item
 
+def get_drive_items_batch(service, item_ids, fields=None):
+    """Get several items by id using batch requests; returns dict of id: item."""
+    items = {}
+    if fields is None:
+        fields = '\
+            id, name, mimeType, modifiedTime, ownedByMe, \
+            sharedWithMeTime, owners, parents, permissions, capabilities \
+        '
+
+    for item_id, result in get_backend(service).get_items(item_ids, fields=fields).items():
+        if isinstance(result, Exception):
+            logging.error(result)
+        else:
+            items[item_id] = result
+    return items
+
+def get_permissions_batch(service, item_ids):
+    """Get the permissions of several items using batch requests; returns dict of id: list."""
+    permissions = {}
+    for item_id, result in get_backend(service).get_permissions(item_ids).items():
+        if isinstance(result, Exception):
+            logging.error(result)
+        else:
+            permissions[item_id] = result
+    return permissions
+
 def get_shared_drive_list(service, name, page_token=None):
     """Get results of search query on specified account."""
-    all_results = []
-    while True:
-        try:
-            response = service.drives().list(pageToken=page_token).execute()
-        except Exception as e:
-            # print(f"Error: {e}")
-            logging.error(e)
-            exit(1)
-        for item in response.get('drives', []):
-            all_results.append(item)
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+    global shared_drive_list
+    with shared_drive_list_lock:
+        if shared_drive_list is None:
+            shared_drive_list = list_shared_drives(service, page_token)
+    return shared_drive_list
+
+def list_shared_drives(service, page_token=None):
+    try:
+        all_results = get_backend(service).list_shared_drives(page_token)
+    except Exception as e:
+        # print(f"Error: {e}")
+        logging.error(e)
+        exit(1)
     return all_results
 
 def validate_shared_drive_destination(service, dest_drive_string, dest_path_names):
@@ -234,101 +329,88 @@ def get_shared_drive_name_from_path_string(path_string):
     dest_drive_string = path_string.split('>')[0].strip()
     return dest_drive_string
 
-def get_user_drive_search_results(service, query, page_token=None):
+def get_user_drive_search_results(service, query, page_token=None, fields=None):
     """Get results of search query on specified account."""
     # Get all useful fields at one time to minimize network traffic.
-    fields = '\
-        nextPageToken, files(id, name, mimeType, modifiedTime, ownedByMe, \
-        sharedWithMeTime, owners, parents, permissions)\
-    '
-    results = []
-    while True:
-        try:
-            response = service.files().list(
-                q=query,
-                # Limited to 'user' to speed up search.
-                corpora='user',
-                spaces='drive',
-                supportsAllDrives=True,
-                fields=fields,
-                pageToken=page_token
-            ).execute()
-        except Exception as e:
-            print(f"Error: {e}")
-            exit(1)
-        for item in response.get('files', []):
-            results.append(item)
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+    if fields is None:
+        fields = USER_DRIVE_FIELDS
+    try:
+        results = get_backend(service).search(
+            query,
+            # Limited to 'user' to speed up search.
+            corpora='user',
+            fields=fields,
+            page_token=page_token,
+        )
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
     return results
 
-def get_shared_drive_search_results(service, shared_drive_id, query, page_token=None):
+def get_shared_drive_search_results(service, shared_drive_id, query, page_token=None, fields=None):
     """Get results of search query on specified account."""
     # Get all useful fields at one time to minimize network traffic.
-    fields = '\
-        nextPageToken, files(id, name, driveId, mimeType, modifiedTime, ownedByMe, \
-        sharedWithMeTime, owners, parents, permissions, capabilities)\
-    '
-    results = []
-    while True:
-        try:
-            response = service.files().list(
-                q=query,
-                driveId=shared_drive_id,
-                # Limited to 'drive' to speed up search.
-                corpora='drive',
-                spaces='drive',
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                fields=fields,
-                pageToken=page_token
-            ).execute()
-        except Exception as e:
-            print(f"Error: {e}")
-            exit(1)
-        for item in response.get('files', []):
-            results.append(item)
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+    if fields is None:
+        fields = SHARED_DRIVE_FIELDS
+    try:
+        results = get_backend(service).search(
+            query,
+            # Limited to 'drive' to speed up search.
+            corpora='drive',
+            drive_id=shared_drive_id,
+            fields=fields,
+            page_token=page_token,
+        )
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
     return results
 
-def get_all_drive_search_results(service, query, page_token=None):
+def get_all_drive_search_results(service, query, page_token=None, fields=None):
     """Get results of search query on specified account."""
     # Get all useful fields at one time to minimize network traffic.
-    fields = '\
-        nextPageToken, files(id, name, driveId, mimeType, modifiedTime, ownedByMe, \
-        sharedWithMeTime, owners, parents, permissions, capabilities)\
-    '
-    results = []
-    while True:
-        try:
-            response = service.files().list(
-                q=query,
-                corpora='allDrives',
-                spaces='drive',
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True,
-                fields=fields,
-                pageToken=page_token,
-            ).execute()
-        except Exception as e:
-            print(f"Error: {e}")
-            exit(1)
-        for item in response.get('files', []):
-            results.append(item)
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
+    if fields is None:
+        fields = SHARED_DRIVE_FIELDS
+    try:
+        results = get_backend(service).search(
+            query,
+            corpora='allDrives',
+            fields=fields,
+            page_token=page_token,
+        )
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
     return results
 
-def get_children(service, folder_id, shared_drive=None):
-    query = f"'{folder_id}' in parents"
-    if not shared_drive:
-        children = get_user_drive_search_results(service, query)
-    else:
-        children = get_shared_drive_search_results(service, shared_drive.get('id'), query)
+def get_children(service, folder_id, shared_drive=None, fields=None):
+    drive_id = shared_drive.get('id') if shared_drive else None
+    if fields is None:
+        fields = SHARED_DRIVE_FIELDS if drive_id else USER_DRIVE_FIELDS
+    try:
+        children = get_backend(service).list_children(folder_id, drive_id=drive_id, fields=fields)
+    except Exception as e:
+        print(f"Error: {e}")
+        exit(1)
+    return children
+
+def get_children_many(service, folders, fields=None):
+    """Get the children of several folders at once; returns a list of children per folder."""
+    folder_ids = [(f.get('id'), f.get('driveId')) for f in folders]
+    results = {}
+    # Default fields depend on the drive, so list each kind separately.
+    for in_shared_drive in [False, True]:
+        ids = [(i, d) for i, d in folder_ids if bool(d) == in_shared_drive]
+        if not ids:
+            continue
+        default_fields = SHARED_DRIVE_FIELDS if in_shared_drive else USER_DRIVE_FIELDS
+        results.update(get_backend(service).list_children_many(ids, fields=fields or default_fields))
+    children = []
+    for folder_id, drive_id in folder_ids:
+        if isinstance(results.get(folder_id), Exception):
+            print(f"Error: {results.get(folder_id)}")
+            exit(1)
+        children.append(results.get(folder_id, []))
     return children
 
 def search_drive_item_name(service, name_string='', type='folder'):
@@ -345,7 +427,13 @@ def search_drive_item_name(service, name_string='', type='folder'):
 def find_drive_item(service, name_string='', type='folder', shared_drive=None, all_drives=False):
     """Search for "folder_string" among Drive folders and folder IDs."""
     name_escaped = name_string.replace("'", "\\'")
-    if type == 'folder':
+    results = None
+    if type == 'folder' and prefetcher:
+        results = prefetcher.find_folders(name_string, shared_drive=shared_drive, all_drives=all_drives)
+    if results is not None:
+        # Use prefetched folder index.
+        pass
+    elif type == 'folder':
         q = f"name = '{name_escaped}' and not trashed and \
             mimeType = 'application/vnd.google-apps.folder'"
         if shared_drive:
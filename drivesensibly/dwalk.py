@@ -0,0 +1,89 @@
+import logging
+
+import dutils
+
+# Most folders whose children are listed at once by "get_children_many".
+MAX_FRONTIER = 200
+
+
+def walk_tree(root, get_children, pre_visit=None, post_visit=None, is_branch=None, visited=None, progress=None, get_children_many=None):
+    """
+    Walk the tree under "root" iteratively, depth-first, in child order.
+
+    get_children(item) returns the list of child items of a branch item.
+    pre_visit(item, parents) is called before the item's children are walked;
+    returning False prunes the item's children and skips its post_visit.
+    post_visit(item, parents) is called after all of the item's children have
+    been walked. "parents" is the list of ancestor items, starting with root.
+    Items whose id is already in "visited" are skipped, so that items reachable
+    through several parents are only handled once. Discovered and processed
+    items are counted in "progress", if given.
+
+    get_children_many(items), if given, returns the list of children of each
+    of several branch items; when a branch's children are needed, those of up
+    to MAX_FRONTIER branches waiting on the stack are listed with it, so that
+    they can be fetched concurrently. The walk order is unchanged.
+    """
+    if is_branch is None:
+        is_branch = dutils.item_is_folder
+    if visited is None:
+        visited = set()
+
+    # Each stack entry is (item, parents, post); "post" marks the entry that
+    # triggers post_visit once all of the item's children have been popped.
+    stack = [(root, [], False)]
+    # Children listed ahead of their branch being walked, by branch id.
+    listed = {}
+    if progress:
+        progress.add_discovered()
+    while stack:
+        item, parents, post = stack.pop()
+        if post:
+            post_visit(item, parents)
+            continue
+
+        item_id = item.get('id')
+        if item_id in visited:
+            logging.debug(f"Already visited: \"{item.get('name')}\" ({item_id})")
+            if progress:
+                progress.add_processed()
+            listed.pop(item_id, None)
+            continue
+        visited.add(item_id)
+
+        pruned = pre_visit and pre_visit(item, parents) is False
+        if progress:
+            progress.add_processed()
+        if pruned:
+            # Prune this item's subtree.
+            listed.pop(item_id, None)
+            continue
+        if post_visit:
+            stack.append((item, parents, True))
+        if is_branch(item):
+            new_parents = [*parents, item]
+            if get_children_many is None:
+                children = get_children(item)
+            else:
+                if item_id not in listed:
+                    listed.update(list_frontier(item, stack, get_children_many, is_branch, visited, listed))
+                children = listed.pop(item_id)
+            if progress:
+                progress.add_discovered(len(children))
+            # Push in reverse so that children are popped in their listed order.
+            for child in reversed(children):
+                stack.append((child, new_parents, False))
+    return visited
+
+def list_frontier(item, stack, get_children_many, is_branch, visited, listed):
+    """List the children of "item" and of the next branches on the stack."""
+    frontier = [item]
+    for entry, parents, post in reversed(stack):
+        if len(frontier) >= MAX_FRONTIER:
+            break
+        entry_id = entry.get('id')
+        if not post and is_branch(entry) and entry_id not in visited and entry_id not in listed:
+            frontier.append(entry)
+    # Items reachable through several parents may be on the stack twice.
+    frontier = list({f.get('id'): f for f in frontier}.values())
+    return zip([f.get('id') for f in frontier], get_children_many(frontier))
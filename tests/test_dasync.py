@@ -0,0 +1,154 @@
+import json
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).parents[1] / 'drivesensibly'))
+
+import dutils  # noqa: E402
+import dasync  # noqa: E402
+import dbackend  # noqa: E402
+import dlist  # noqa: E402
+import dprofile  # noqa: E402
+
+# Folders under the stand-in's "top" folder; more than a googleapiclient batch.
+FOLDERS = 150
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the few Drive v3 endpoints the tests call."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, obj):
+        server = self.server
+        with server.lock:
+            server.clients.add(self.client_address)
+        body = json.dumps(obj).encode('utf-8') if obj is not None else b''
+        self.send_response(status)
+        if status != 204:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            # Long enough for concurrent requests to overlap.
+            time.sleep(0.05)
+            if url.path == '/drive/v3/files' and query.get('q', [''])[0].startswith("'top' in parents"):
+                folders = [{'id': f'd{i}', 'name': f'D{i}', 'mimeType': dbackend.FOLDER_MIMETYPE} for i in range(FOLDERS)]
+                return self.send_json(200, {'files': folders})
+            if url.path == '/drive/v3/files' and query.get('q', [''])[0].startswith("'d"):
+                folder_id = query['q'][0].split("'")[1]
+                return self.send_json(200, {'files': [{'id': f'{folder_id}f', 'name': 'file'}]})
+            if url.path == '/drive/v3/files':
+                if query.get('pageToken'):
+                    return self.send_json(200, {'files': [{'id': 'f2'}]})
+                return self.send_json(200, {'files': [{'id': 'f1'}], 'nextPageToken': 'page2'})
+            if url.path == '/drive/v3/files/flaky' and server.failures:
+                server.failures -= 1
+                return self.send_json(503, {'error': 'unavailable'})
+            if url.path == '/drive/v3/changes/startPageToken':
+                return self.send_json(200, {'startPageToken': '7'})
+            item_id = url.path.rsplit('/', 1)[1]
+            self.send_json(200, {'id': item_id, 'auth': self.headers.get('Authorization')})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def do_DELETE(self):
+        self.send_json(204, None)
+
+
+class StandInServer(ThreadingHTTPServer):
+    # Room for a whole batch of new connections at once.
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class Credentials(object):
+    valid = True
+    token = 'test-token'
+
+
+class AsyncClientTests(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.lock = threading.Lock()
+        self.server.clients = set()
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.service = dasync.build_service(Credentials(), base_url=base_url)
+        self.addCleanup(self.service.close)
+
+    def test_get_with_token(self):
+        item = self.service.files().get(fileId='abc', fields='id').execute()
+        self.assertEqual(item, {'id': 'abc', 'auth': 'Bearer test-token'})
+
+    def test_search_follows_pages(self):
+        results = dbackend.get_backend(self.service).search("'root' in parents")
+        self.assertEqual([r['id'] for r in results], ['f1', 'f2'])
+
+    def test_server_error_is_retried(self):
+        self.server.failures = 1
+        item = self.service.files().get(fileId='flaky').execute()
+        self.assertEqual(item.get('id'), 'flaky')
+
+    def test_delete_has_empty_response(self):
+        self.assertEqual(self.service.files().delete(fileId='abc').execute(), {})
+
+    def test_changes_start_page_token(self):
+        self.assertEqual(dbackend.get_backend(self.service).get_start_page_token(), '7')
+
+    def test_batch_runs_concurrently_on_kept_alive_connections(self):
+        item_ids = [f"item{i}" for i in range(50)]
+        items = dutils.get_drive_items_batch(self.service, item_ids, fields='id')
+        self.assertEqual(sorted(items), sorted(item_ids))
+        self.assertGreater(self.server.max_in_flight, 1)
+        # Connections are reused by the next batch rather than reopened.
+        clients = len(self.server.clients)
+        dutils.get_drive_items_batch(self.service, item_ids, fields='id')
+        self.assertEqual(len(self.server.clients), clients)
+
+    def test_walk_lists_folders_concurrently(self):
+        lines = []
+        top = {'id': 'top', 'name': 'Top', 'mimeType': dbackend.FOLDER_MIMETYPE}
+        counts = dlist.list_files_recursively('me', self.service, top, output=lines.append)
+        self.assertEqual(counts, {'total_ct': 2 * FOLDERS, 'folder_ct': FOLDERS})
+        self.assertEqual(lines[1:3], ['Top > D0', 'Top > D0 > file'])
+        self.assertGreater(self.server.max_in_flight, dbackend.BATCH_SIZE)
+
+    def test_profiler_times_requests(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = dprofile.Profiler(Path(tmp) / 'run.log')
+            profiler.start(self.service)
+            dutils.get_drive_items_batch(self.service, ['a', 'b', 'c'], fields='id')
+            profiler.stop()
+        self.assertEqual(sorted(e['name'] for e in profiler.events), ['GET /drive/v3/files/{id}'] * 3)
+        self.assertEqual({e['args']['status'] for e in profiler.events}, {200})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,371 @@
+import importlib.util
+import json
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+SRC = Path(__file__).parents[1] / 'drivesensibly'
+sys.path.insert(0, str(SRC))
+
+import dutils  # noqa: E402
+import dbackend  # noqa: E402
+import dlist  # noqa: E402
+
+FOLDER = dbackend.FOLDER_MIMETYPE
+HAVE_GOOGLE = all(importlib.util.find_spec(m) for m in ['googleapiclient', 'google_auth_oauthlib', 'httplib2'])
+# Modules that import the Google client libraries.
+GOOGLE_MODULES = ['app', 'dcassette', 'djobs', 'dprefetch']
+
+
+def make_items(user='me@example.org'):
+    """Top > Sub0..Sub2 > file0..file2, plus a shared drive with a Dest folder."""
+    def owned(item):
+        item['owners'] = [{'emailAddress': user}]
+        item['ownedByMe'] = True
+        item['permissions'] = [{'id': 'p-new', 'emailAddress': 'new@example.org', 'role': 'writer', 'type': 'user'}]
+        return item
+
+    items = [owned({'id': 'top', 'name': 'Top', 'mimeType': FOLDER})]
+    for i in range(3):
+        items.append(owned({'id': f's{i}', 'name': f'Sub{i}', 'mimeType': FOLDER, 'parents': ['top']}))
+        for j in range(3):
+            items.append(owned({
+                'id': f's{i}f{j}',
+                'name': f'file{j}',
+                'mimeType': 'text/plain',
+                'size': '10',
+                'md5Checksum': f'md5-{j}',
+                'parents': [f's{i}'],
+            }))
+    items.append({
+        'id': 'dest',
+        'name': 'Dest',
+        'mimeType': FOLDER,
+        'parents': ['sd'],
+        'driveId': 'sd',
+        'capabilities': {'canAddChildren': True},
+    })
+    drives = [{'id': 'sd', 'name': 'Shared'}]
+    return items, drives, user
+
+
+class ImportTests(unittest.TestCase):
+    def test_modules_import_in_any_order(self):
+        for path in sorted(SRC.glob('*.py')):
+            module = path.stem
+            if module in GOOGLE_MODULES and not HAVE_GOOGLE:
+                continue
+            with self.subTest(module=module):
+                result = subprocess.run(
+                    [sys.executable, '-c', f"import {module}"],
+                    cwd=SRC,
+                    capture_output=True,
+                    text=True,
+                )
+                self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class MemoryBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = dbackend.MemoryBackend(*make_items())
+
+    def test_list_files(self):
+        counts = dlist.run_list_files(self.backend.user, self.backend, self.backend.get_item('top'))
+        self.assertEqual(counts, {'total_ct': 13, 'folder_ct': 4})
+
+    def test_list_files_sharded(self):
+        import dchown
+        counts = dlist.run_list_files(self.backend.user, self.backend, self.backend.get_item('top'), processes=2)
+        self.assertEqual(counts, {'total_ct': 13, 'folder_ct': 4})
+        search = self.backend.search
+
+        def fail_sub1(query, *args, **kwargs):
+            if query.startswith("'s1' in parents"):
+                exit(1)
+            return search(query, *args, **kwargs)
+
+        with mock.patch.object(self.backend, 'search', fail_sub1), self.assertLogs(level='ERROR'):
+            counts = dchown.run_change_owner(self.backend.user, self.backend, self.backend.get_item('top'), 'new@example.org', processes=2)
+        # Sub1 itself was changed before its children couldn't be listed.
+        self.assertEqual(counts, {'total_ct': 10, 'failed_ct': 0, 'error_ct': 1})
+
+    def test_list_children_and_delete(self):
+        self.backend.trash_item('s0f0')
+        self.assertEqual([c['id'] for c in self.backend.list_children('s0')], ['s0f1', 's0f2'])
+        self.backend.delete_item('s0')
+        self.assertEqual([c['id'] for c in self.backend.list_children('top')], ['s1', 's2'])
+        self.assertNotIn('s0f1', self.backend.items)
+
+    def test_ancestors_batched_in_order(self):
+        dutils.ancestor_cache.clear()
+        self.addCleanup(dutils.ancestor_cache.clear)
+        with mock.patch.object(dutils, 'get_drive_items_batch', wraps=dutils.get_drive_items_batch) as batch:
+            ancestors = dutils.get_ancestors(self.backend, {'s2', 's0', 'top', 's1'})
+        self.assertEqual(sorted(ancestors), ['s0', 's1', 's2', 'top'])
+        self.assertEqual(batch.call_args.args[1], ['s0', 's1', 's2', 'top'])
+
+    def test_find_name_with_and(self):
+        self.backend.create_item({'id': 'tj', 'name': 'Tom and Jerry', 'mimeType': FOLDER})
+        item = dutils.find_drive_item(self.backend, name_string='Tom and Jerry')
+        self.assertEqual(item.get('id'), 'tj')
+
+    def test_change_owner(self):
+        import dchown
+        counts = dchown.run_change_owner(self.backend.user, self.backend, self.backend.get_item('top'), 'new@example.org')
+        self.assertEqual(counts, {'total_ct': 13, 'failed_ct': 0})
+        self.assertEqual(self.backend.get_item('s1f1')['owners'], [{'emailAddress': 'new@example.org'}])
+
+    def test_trashed_folders_not_listed(self):
+        import dmove
+        sub0 = self.backend.get_item('s0')
+        dmove.run_move_folder(self.backend.user, self.backend, sub0, 'Shared > Dest')
+        self.assertTrue(self.backend.items['s0'].get('trashed'))
+        counts = dlist.run_list_files(self.backend.user, self.backend, self.backend.get_item('top'))
+        self.assertEqual(counts, {'total_ct': 9, 'folder_ct': 3})
+
+    def test_audit_shared_drive_permissions(self):
+        import daudit
+        self.backend.create_item({
+            'id': 'sdf',
+            'name': 'Report',
+            'mimeType': 'text/plain',
+            'parents': ['dest'],
+            'driveId': 'sd',
+            'permissions': [{'id': 'p-g', 'emailAddress': 'Team@example.org', 'role': 'reader', 'type': 'group'}],
+        })
+        index, types = daudit.get_sharing_index(self.backend, self.backend.get_item('dest'))
+        self.assertEqual(index, {'team@example.org': {'reader': [('sdf', 'Dest > Report')]}})
+
+    def test_move_folder(self):
+        import dmove
+        result = dmove.run_move_folder(self.backend.user, self.backend, self.backend.get_item('top'), 'Shared > Dest')
+        self.assertNotEqual(result, 1)
+        moved = self.backend.get_item('s2f0')
+        self.assertEqual(moved.get('driveId'), 'sd')
+        self.assertEqual(dutils.get_item_path(self.backend, moved), 'Shared > Dest > Top > Sub2 > file0')
+
+    def test_move_folder_with_failed_file(self):
+        import dmove
+        move_item = self.backend.move_item
+
+        def fail_one(item_id, add_parents, remove_parents):
+            if item_id == 's1f2':
+                raise RuntimeError("Move failed")
+            return move_item(item_id, add_parents, remove_parents)
+
+        with mock.patch.object(self.backend, 'move_item', fail_one), self.assertLogs(level='ERROR'):
+            result = dmove.run_move_folder(self.backend.user, self.backend, self.backend.get_item('top'), 'Shared > Dest', verify=True)
+        self.assertEqual(result, 1)
+        # Only the failed file's folder and its ancestors are kept.
+        self.assertEqual(self.backend.items['s1f2']['parents'], ['s1'])
+        self.assertEqual([i for i in ['top', 's0', 's1', 's2'] if self.backend.items[i].get('trashed')], ['s0', 's2'])
+
+
+    def test_move_into_partial_destination(self):
+        import dmove
+        # An earlier, interrupted move left part of the skeleton in place.
+        self.backend.create_item({'id': 'dtop', 'name': 'Top', 'mimeType': FOLDER, 'parents': ['dest']})
+        self.backend.create_item({'id': 'ds1', 'name': 'Sub1', 'mimeType': FOLDER, 'parents': ['dtop']})
+        self.backend.create_item({'id': 'keep', 'name': 'keep', 'mimeType': 'text/plain', 'parents': ['ds1']})
+        result = dmove.run_move_folder(self.backend.user, self.backend, self.backend.get_item('top'), 'Shared > Dest', verify=True)
+        self.assertNotEqual(result, 1)
+        # Existing folders are reused rather than duplicated.
+        self.assertEqual([c['name'] for c in self.backend.list_children('dest', 'sd')], ['Top'])
+        self.assertEqual(sorted(c['name'] for c in self.backend.list_children('dtop', 'sd')), ['Sub0', 'Sub1', 'Sub2'])
+        self.assertEqual(sorted(c['name'] for c in self.backend.list_children('ds1', 'sd')), ['file0', 'file1', 'file2', 'keep'])
+        # Emptied source folders are trashed; reused destination folders aren't.
+        self.assertTrue(all(self.backend.items[i].get('trashed') for i in ['top', 's0', 's1', 's2']))
+        self.assertFalse(any(self.backend.items[i].get('trashed') for i in ['dtop', 'ds1', 'keep']))
+
+    def test_list_changes(self):
+        import dchanges
+        self.backend.create_item({'id': 'out', 'name': 'Out', 'mimeType': FOLDER})
+        self.backend.create_item({'id': 'outf', 'name': 'ofile', 'mimeType': 'text/plain', 'parents': ['out']})
+        with tempfile.TemporaryDirectory() as tmp:
+            state_file = Path(tmp) / 'run.state.json'
+            dlist.run_list_files(self.backend.user, self.backend, self.backend.get_item('top'), state_file=state_file)
+            state = dchanges.find_state(str(state_file), tmp)
+        self.backend.items['s0f0']['name'] = 'renamed'
+        self.backend.changes.append('s0f0')
+        self.backend.move_item('s1f1', 's2', 's1')
+        self.backend.trash_item('s2f2')
+        self.backend.create_item({'id': 'new', 'name': 'new', 'mimeType': 'text/plain', 'parents': ['s0']})
+        # A folder moved in from outside brings its unchanged contents.
+        self.backend.move_item('out', 'top', '')
+
+        with self.assertLogs(level='INFO') as logs:
+            counts = dchanges.run_list_changes(self.backend.user, self.backend, self.backend.get_item('top'), state)
+        self.assertEqual([r.getMessage() for r in logs.records if '\t' in r.getMessage()], [
+            "added\tTop > Out",
+            "added\tTop > Out > ofile",
+            "renamed\tTop > Sub0 > file0 -> Top > Sub0 > renamed",
+            "added\tTop > Sub0 > new",
+            "moved\tTop > Sub1 > file1 -> Top > Sub2 > file1",
+            "removed\tTop > Sub2 > file2",
+        ])
+        self.assertEqual(
+            {k: counts[k] for k in ['added_ct', 'removed_ct', 'renamed_ct', 'moved_ct', 'total_ct', 'folder_ct']},
+            {'added_ct': 3, 'removed_ct': 1, 'renamed_ct': 1, 'moved_ct': 1, 'total_ct': 15, 'folder_ct': 5},
+        )
+
+    def test_folder_usage(self):
+        self.backend.create_item({'id': 'deep', 'name': 'Deep', 'mimeType': FOLDER, 'parents': ['s0']})
+        self.backend.create_item({'id': 'big', 'name': 'big', 'mimeType': 'text/plain', 'size': '100', 'parents': ['deep']})
+        totals, largest = dlist.get_usage_recursively(self.backend, self.backend.get_item('top'), top=3)
+        self.assertEqual(totals, [190, 10, 4])
+        # Totals roll up from Deep to Sub0 to Top.
+        self.assertEqual([(size, path, file_ct, folder_ct) for size, i, path, file_ct, folder_ct in largest], [
+            (190, 'Top', 10, 4),
+            (130, 'Top > Sub0', 4, 1),
+            (100, 'Top > Sub0 > Deep', 1, 0),
+        ])
+        counts = dlist.run_folder_usage(self.backend.user, self.backend, self.backend.get_item('top'))
+        self.assertEqual(counts, {'bytes': 190, 'total_ct': 15, 'folder_ct': 5})
+
+    def test_find_duplicates(self):
+        # Same checksum with another size, and same size with another checksum.
+        self.backend.create_item({'id': 'x', 'name': 'x', 'mimeType': 'text/plain', 'size': '20', 'md5Checksum': 'md5-0', 'parents': ['top']})
+        self.backend.create_item({'id': 'y', 'name': 'y', 'mimeType': 'text/plain', 'size': '10', 'md5Checksum': 'md5-y', 'parents': ['top']})
+        duplicates = dlist.get_duplicates_recursively(self.backend, self.backend.get_item('top'))
+        self.assertEqual(
+            {key: sorted(paths) for key, paths in duplicates.items()},
+            {(10, f'md5-{j}'): [f'Top > Sub{i} > file{j}' for i in range(3)] for j in range(3)},
+        )
+
+    def test_compare_trees(self):
+        import dmove
+        source = dlist.get_tree_signatures(self.backend, self.backend.get_item('top'))
+        destination = dict(source)
+        del destination['Sub0 > file0']
+        destination['Sub1 > file1'] = [('text/plain', '11', 'md5-1')]
+        destination['Sub2 > extra'] = [('text/plain', '1', 'md5-e')]
+        self.assertEqual(dmove.compare_trees(source, source), ([], [], []))
+        self.assertEqual(dmove.compare_trees(source, destination), (['Sub0 > file0'], ['Sub2 > extra'], ['Sub1 > file1']))
+
+
+class StateIndexTests(unittest.TestCase):
+    def test_lookups_use_index(self):
+        import dchanges
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            # A state saved before the index existed is indexed when first seen.
+            old = dchanges.get_new_state({'id': 'top', 'name': 'Top'}, '5')
+            old['items'] = {'a': ['A', 'top', 0]}
+            with open(tmp / 'run1.state.json', 'w') as f:
+                json.dump(old, f)
+            new = dchanges.get_new_state({'id': 'top', 'name': 'Top'}, '7')
+            new['items'] = {'a': ['A', 'top', 0], 'b': ['B', 'top', 0]}
+            dchanges.save_state(new, tmp / 'run2.state.json')
+            self.assertEqual(sorted(json.loads((tmp / 'states.json').read_text())), ['run1.state.json', 'run2.state.json'])
+
+            with mock.patch('json.load', wraps=json.load) as load:
+                self.assertEqual(dchanges.get_item_count(tmp, 'top'), 2)
+                self.assertIsNone(dchanges.get_item_count(tmp, 'other'))
+                # Only the index is parsed, then the matching state.
+                self.assertEqual(dchanges.find_state('5', tmp)['items'], old['items'])
+            self.assertEqual(load.call_count, 4)
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_worker_threads_are_profiled(self):
+        import pstats
+        import threading
+        import dprofile
+
+        def work():
+            sorted(range(1000))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler = dprofile.Profiler(Path(tmp) / 'run.log')
+            with self.assertLogs(level='WARNING'):
+                profiler.start(dbackend.MemoryBackend())
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+            profiler.stop()
+            stats = pstats.Stats(str(profiler.profile_path))
+        self.assertIn('work', [name for filename, line, name in stats.stats])
+
+@unittest.skipUnless(HAVE_GOOGLE, "Google client libraries not installed")
+class JobsFileTests(unittest.TestCase):
+    def test_read_jobs(self):
+        import djobs
+
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_file = Path(tmp) / 'jobs.csv'
+            csv_file.write_text('action,folder,arg\n# comment\nList,"Top"\nchown,Top\nmove,Top,Shared > Dest\nsort,Top\n,Top\n')
+            json_file = Path(tmp) / 'jobs.json'
+            json_file.write_text(json.dumps([{'action': 'list-details', 'folder': 'Top'}, {'action': 'list'}]))
+            csv_jobs = djobs.read_jobs(csv_file)
+            json_jobs = djobs.read_jobs(json_file)
+        self.assertEqual([(j['num'], j['action'], j['folder'], j['arg'], j['error']) for j in csv_jobs], [
+            (1, 'list', 'Top', None, None),
+            (2, 'chown', 'Top', None, 'no argument given for "chown"'),
+            (3, 'move', 'Top', 'Shared > Dest', None),
+            (4, 'sort', 'Top', None, 'unknown action "sort"'),
+            (5, '', 'Top', None, 'unknown action ""'),
+        ])
+        self.assertEqual([j['error'] for j in json_jobs], [None, 'no folder given'])
+
+
+@unittest.skipUnless(HAVE_GOOGLE, "Google client libraries not installed")
+class AppSnapshotTests(unittest.TestCase):
+    """Run each folder action through app.main() on a --snapshot MemoryBackend."""
+    def setUp(self):
+        import app
+        self.app = app
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        tmp = Path(self.tmp.name)
+        self.snapshot = tmp / 'snapshot.json'
+        dbackend.MemoryBackend(*make_items()).save_snapshot(self.snapshot)
+        log_path = tmp / 'run.log'
+        patcher = mock.patch.object(app.dlog, 'setup_logging', return_value=log_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Each run starts without caches from the previous one.
+        dutils.ancestor_cache.clear()
+        dutils.shared_drive_list = None
+
+    def run_app(self, *args):
+        argv = ['app.py', '--snapshot', str(self.snapshot), *args]
+        with mock.patch.object(sys, 'argv', argv):
+            return self.app.main()
+
+    def test_folder_actions(self):
+        audit_file = Path(self.tmp.name) / 'audit.csv'
+        for args in [['-l'], ['-L'], ['-u'], ['--duplicates'], ['--audit', str(audit_file)], ['-o', 'new@example.org']]:
+            with self.subTest(args=args):
+                self.run_app(*args, 'Top')
+
+    def test_move_verify_exit_status(self):
+        self.assertIsNone(self.run_app('-d', 'Shared > Dest', '--verify', 'Top'))
+        with mock.patch.object(self.app.dmove, 'verify_move', return_value=False):
+            self.assertEqual(self.run_app('-d', 'Shared > Dest', '--verify', 'Top'), 1)
+
+    def test_jobs(self):
+        tmp = Path(self.tmp.name)
+        jobs_file = tmp / 'jobs.csv'
+        jobs_file.write_text("action,folder,arg\nlist,Top\nlist,Nope\n")
+        # Job logs only get records that the root logger lets through.
+        with self.assertLogs(level='INFO'):
+            self.assertEqual(self.run_app('--jobs', str(jobs_file)), 1)
+        self.assertIn("Total: 4 folders, 9 files.", (tmp / 'run-job1.log').read_text())
+        jobs_file.write_text("list,Top\n")
+        self.assertIsNone(self.run_app('--jobs', str(jobs_file)))
+
+    def test_since(self):
+        self.run_app('-l', 'Top')
+        state_file = Path(self.tmp.name) / 'run.state.json'
+        with open(state_file) as f:
+            self.assertEqual(len(json.load(f)['items']), 13)
+        self.run_app('--since', str(state_file), 'Top')
+
+
+if __name__ == '__main__':
+    unittest.main()